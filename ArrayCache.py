@@ -0,0 +1,107 @@
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+import Instrument as IN
+
+# Content-addressed on-disk cache of arrays computed from a catalogue.
+#
+# An entry is keyed on the identity of the input file (absolute path, size,
+# mtime), the name of the computation and its parameters; the key is the
+# SHA-1 of those, and the entry is <cache_dir>/<key>.npz holding the arrays
+# returned by the computation.  Rewriting the catalogue changes its
+# identity, so stale entries are never hit and age out.
+#
+#   arrays = AC.Cached(halo_snapshot, 'SubHaloPosRatio', {}, compute)
+#
+# compute() returns a dict of arrays.  A hit refreshes the entry's mtime;
+# after every write the least recently used entries, other than the one just
+# written, are removed until the cache is back under max_bytes.  Results
+# larger than max_bytes on their own are returned without being cached.
+# The cache directory defaults to halo_cache/ next to the catalogue.
+
+DEFAULT_CACHE_BYTES = 2**30
+
+def CacheDir(halo_snapshot):
+    return os.path.join(os.path.dirname(os.path.abspath(halo_snapshot)), 'halo_cache')
+
+def FileIdentity(path):
+    st = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+def CacheKey(halo_snapshot, name, params):
+    identity = {'file': FileIdentity(halo_snapshot), 'name': name, 'params': params}
+    text = json.dumps(identity, sort_keys=True, default=repr)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def CacheEntries(cache_dir):
+    # (mtime, size, path) of every entry, least recently used first
+    entries = []
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            if name.endswith('.npz'):
+                path = os.path.join(cache_dir, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+    entries.sort()
+    return entries
+
+def Evict(cache_dir, max_bytes=None, keep=None):
+    # remove least recently used entries, never `keep`, until under max_bytes
+    if max_bytes is None:
+        max_bytes = DEFAULT_CACHE_BYTES
+    entries = CacheEntries(cache_dir)
+    total = sum(size for mtime, size, path in entries)
+    removed = 0
+    for mtime, size, path in entries:
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
+
+def ClearCache(cache_dir):
+    for mtime, size, path in CacheEntries(cache_dir):
+        os.remove(path)
+
+def Cached(halo_snapshot, name, params, compute, cache_dir=None, max_bytes=None):
+    if cache_dir is None:
+        cache_dir = CacheDir(halo_snapshot)
+    path = os.path.join(cache_dir, CacheKey(halo_snapshot, name, params)+'.npz')
+    if os.path.exists(path):
+        try:
+            with np.load(path) as saved:
+                arrays = {key: saved[key] for key in saved.files}
+            os.utime(path)
+            IN.Count('cache_hits')
+            return arrays
+        except (OSError, ValueError):
+            # entry evicted or truncated under us: recompute it
+            pass
+
+    IN.Count('cache_misses')
+    arrays = compute()
+    if max_bytes is None:
+        max_bytes = DEFAULT_CACHE_BYTES
+    if sum(np.asarray(a).nbytes for a in arrays.values()) > max_bytes:
+        # an entry over the whole budget would only push out everything else
+        IN.Count('cache_skipped')
+        return arrays
+    os.makedirs(cache_dir, exist_ok=True)
+    # write under a temporary name so concurrent readers never see half an entry
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+    with os.fdopen(fd, 'wb') as out:
+        np.savez(out, **arrays)
+    os.replace(tmp, path)
+    Evict(cache_dir, max_bytes, keep=path)
+    return arrays
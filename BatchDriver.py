@@ -0,0 +1,152 @@
+import os
+import zipfile
+import multiprocessing
+import numpy as np
+import HaloSummary as HS
+import HaloEngine as HE
+import MassComp as MC
+import MassRelation as MR
+import SubHaloPos as SHP
+import SubHaloVel as SHV
+import QuantileSketch as QS
+
+# Runs the catalogue analyses over a range of snapshots on a process pool.
+#
+# Each snapshot gets one engine traversal feeding the NumOcup,
+# MassRelation, SubHaloPosComp and SubHaloVelComp accumulators, whose
+# results (occupancy counts, sub-mass statistics, position and speed ratio
+# histograms per occupancy range) are saved as <out_dir>/snap_<snap>.npz
+# together with the size and mtime of the catalogue, the occupancy ranges
+# and the bin count (written under a temporary name and renamed once
+# complete).  Later runs only recompute snapshots whose catalogue or
+# parameters are new or have changed, or whose result file cannot be read,
+# then build time series such as mean occupancy against redshift from the
+# saved results.  The largest sub mass fraction of every host is also
+# stored as a quantile sketch (see QuantileSketch), so snapshots can be
+# pooled with MergedQuantiles.
+#
+#   results = BD.RunSnapshots(range(0, 62), redshifts=z_of_snap, nproc=16)
+#   series = BD.TimeSeries(results)
+#   HP.Render(BD.TimeSeriesFigure(series))
+
+SNAPSHOT_PATTERN = 'halos_{}.hdf5'
+OCCUPANCIES = [(0, 1), (2, 4)]
+
+def SnapLabel(snap):
+    return snap if isinstance(snap, str) else '{:03d}'.format(snap)
+
+def SnapshotAccumulators(occupancies, bins=50):
+    # the MassComp / SubHalo* accumulators, run in one traversal
+    return [MC.NumOcupAcc(), MR.MassRelationAcc(), SHP.SubHaloPosCompAcc(occupancies, bins),
+            SHV.SubHaloVelCompAcc(occupancies, bins)]
+
+def SnapshotStats(halo_snapshot, occupancies, bins=50):
+    # per-snapshot batch results from the analyses' own results
+    occupancy, relation, pos, vel = HE.Traverse(halo_snapshot, SnapshotAccumulators(occupancies, bins))
+    H = occupancy['H']
+    nHalo = int(np.sum(H))
+    nSub = int(np.sum(np.arange(len(H))*H))
+    main_mass = int(np.sum(relation['main_mass'], dtype=np.int64))
+    sub_mass = int(np.sum(relation['tot_sub_mass']))
+    max_fraction = QS.KLLSketch(seed=0)
+    max_fraction.Update(relation['max_fraction'][np.isfinite(relation['max_fraction'])])
+    result = {'nHalo': nHalo, 'nSub': nSub,
+              'mean_occupancy': nSub/nHalo if nHalo else np.nan,
+              'occupied_fraction': 1 - H[0]/nHalo if nHalo else np.nan,
+              'occupancy_counts': H,
+              'sub_mass_fraction': sub_mass/main_mass if main_mass else np.nan,
+              'max_fraction_percentiles': max_fraction.Quantile([0.16, 0.5, 0.84]),
+              'occupancies': np.array(occupancies),
+              'pos_density': np.array([density for density, edges in pos['densities']]),
+              'pos_edges': pos['densities'][0][1],
+              'vel_density': np.array([density for density, edges in vel['densities']]),
+              'vel_edges': vel['densities'][0][1]}
+    result.update(max_fraction.ToArrays('max_fraction_sketch'))
+    return result
+
+def ResultPath(out_dir, snap):
+    return os.path.join(out_dir, 'snap_'+snap+'.npz')
+
+def IsCurrent(result_file, halo_snapshot, occupancies, bins):
+    if not os.path.exists(result_file):
+        return False
+    stamp = HS.SourceStamp(halo_snapshot)
+    try:
+        with np.load(result_file) as saved:
+            return ('max_fraction_sketch_items' in saved.files and 'bins' in saved.files and
+                    saved['source_size'] == stamp['source_size'] and
+                    saved['source_mtime'] == stamp['source_mtime'] and
+                    np.array_equal(saved['occupancies'], np.array(occupancies)) and
+                    saved['bins'] == bins)
+    except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+        # truncated or corrupt result: recompute it
+        return False
+
+def RunSnapshot(args):
+    snap, halo_snapshot, out_dir, occupancies, bins = args
+    result = SnapshotStats(halo_snapshot, occupancies, bins)
+    result.update(HS.SourceStamp(halo_snapshot))
+    result['bins'] = bins
+    result_file = ResultPath(out_dir, snap)
+    with open(HS.TempPath(result_file), 'wb') as out:
+        np.savez(out, **result)
+    os.replace(HS.TempPath(result_file), result_file)
+    return snap
+
+def LoadResult(result_file):
+    with np.load(result_file) as saved:
+        return {key: saved[key] for key in saved.files}
+
+def RunSnapshots(snapshots, pattern=SNAPSHOT_PATTERN, out_dir='BatchResults', occupancies=OCCUPANCIES,
+                 redshifts=None, nproc=1, bins=50):
+    # snapshots: labels or numbers; redshifts: optional {label: z}
+    os.makedirs(out_dir, exist_ok=True)
+    labels = [SnapLabel(snap) for snap in snapshots]
+    todo = []
+    for snap in labels:
+        halo_snapshot = pattern.format(snap)
+        if not os.path.exists(halo_snapshot):
+            print('Snapshot', snap, ': no catalogue', halo_snapshot)
+            continue
+        if not IsCurrent(ResultPath(out_dir, snap), halo_snapshot, occupancies, bins):
+            todo.append((snap, halo_snapshot, out_dir, occupancies, bins))
+    print('Snapshots to compute:', [task[0] for task in todo])
+
+    if nproc > 1 and len(todo) > 1:
+        with multiprocessing.Pool(min(nproc, len(todo))) as pool:
+            for snap in pool.imap_unordered(RunSnapshot, todo):
+                print('Snapshot', snap, 'done')
+    else:
+        for task in todo:
+            print('Snapshot', RunSnapshot(task), 'done')
+
+    results = {}
+    for snap in labels:
+        result_file = ResultPath(out_dir, snap)
+        if os.path.exists(result_file):
+            results[snap] = LoadResult(result_file)
+            if redshifts is not None and snap in redshifts:
+                results[snap]['redshift'] = redshifts[snap]
+    return results
+
+def TimeSeries(results):
+    snaps = sorted(results.keys(), key=lambda snap: int(snap))
+    series = {'snapshot': np.array([int(snap) for snap in snaps]),
+              'redshift': np.array([results[snap].get('redshift', np.nan) for snap in snaps], dtype=np.float64)}
+    for key in ['nHalo', 'nSub', 'mean_occupancy', 'occupied_fraction', 'sub_mass_fraction']:
+        series[key] = np.array([results[snap][key] for snap in snaps], dtype=np.float64)
+    series['max_fraction_median'] = np.array([results[snap]['max_fraction_percentiles'][1] for snap in snaps])
+    return series
+
+def MergedQuantiles(results, q=(0.16, 0.5, 0.84), snaps=None, prefix='max_fraction_sketch'):
+    # quantiles of a sketched statistic pooled over several snapshots
+    if snaps is None:
+        snaps = results.keys()
+    sketch = QS.MergeAll(QS.FromArrays(results[SnapLabel(snap)], prefix) for snap in snaps)
+    if sketch is None:
+        return np.full(len(q), np.nan)
+    return sketch.Quantile(q)
+
+def TimeSeriesFigure(series, key='mean_occupancy', ylabel='Mean number of 0.1 Halos in a 0.2 Halo'):
+    # result for HaloPlots.Render
+    return {'figure': 'TimeSeries', 'series': series, 'key': key, 'ylabel': ylabel}
@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import MockCatalogue as MK
+import Instrument as IN
+import HaloSummary as HS
+import ArrayCache as AC
+import OccupancyIndex as OI
+import MassComp as MC
+import SubHaloPos as SHP
+import SubHaloVel as SHV
+import SubPosVel as SPV
+import HaloPlots as HP
+
+# Times every MassComp/SubHalo* entry point, including rendering, on
+# synthetic catalogues of increasing size and reports seconds per host and
+# per subhalo, so a change in scaling shows up as a growing per-object
+# time.  Each result also carries the Instrument phase times, I/O counters
+# and peak memory.
+#
+#   python Benchmark.py 1000 10000 --out bench.json --baseline old.json --profile prof/
+
+ENTRY_POINTS = [
+    ('ExtractSummary', lambda snap: HS.ExtractSummary(snap)),
+    ('BuildIndex', lambda snap: OI.BuildIndex(snap)),
+    ('SumMassCompPlot', lambda snap: HP.Render(MC.SumMassCompPlot(halo_snapshot=snap))),
+    ('MaxMassCompPlot', lambda snap: HP.Render(MC.MaxMassCompPlot(halo_snapshot=snap))),
+    ('NumOcup', lambda snap: HP.Render(MC.NumOcup(halo_snapshot=snap))),
+    ('SubHaloPos', lambda snap: HP.Render(SHP.SubHaloPos(halo_snapshot=snap, occupancy_l=2, occupancy_h=4))),
+    ('SubHaloPosComp', lambda snap: HP.Render(SHP.SubHaloPosComp(halo_snapshot=snap, occupancies=[(0, 1), (2, 4)]))),
+    ('SubHaloVel', lambda snap: HP.Render(SHV.SubHaloVel(halo_snapshot=snap, occupancy_l=0, occupancy_h=1))),
+    ('SubHaloVelComp', lambda snap: HP.Render(SHV.SubHaloVelComp(halo_snapshot=snap, occupancies=[(0, 1), (2, 4)]))),
+    ('SubHaloPosVel', lambda snap: HP.Render(SPV.SubHaloPosVel(halo_snapshot=snap, occupancy_l=0, occupancy_h=1))),
+    ('SubHaloPosVelDensity', lambda snap: HP.Render(SPV.SubHaloPosVel(halo_snapshot=snap, occupancy_l=0, occupancy_h=1, density=True))),
+]
+
+def TimeCall(func, *args, repeat=1, setup=None):
+    # best of `repeat` calls; setup() runs untimed before each call
+    best = None
+    for k in range(0, repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def Benchmark(sizes=(1000, 10000), repeat=1, workdir=None, quiet=True, profile_dir=None, **mock_args):
+    # the plots are written to Plots/ under a scratch directory
+    cleanup = workdir is None
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='halo_bench_')
+    cwd = os.getcwd()
+    results = []
+    try:
+        os.chdir(workdir)
+        os.makedirs('Plots', exist_ok=True)
+        for nHalo in sizes:
+            snap = 'halos_bench_'+str(nHalo)+'.hdf5'
+            counts = MK.WriteMockCatalogue(snap, nHalo=nHalo, **mock_args)
+            for name, func in ENTRY_POINTS:
+                stdout = sys.stdout
+                if quiet:
+                    sys.stdout = open(os.devnull, 'w')
+                IN.Reset()
+                profile = None
+                if profile_dir is not None:
+                    profile = os.path.join(profile_dir, name+'_'+str(nHalo)+'.prof')
+                try:
+                    with IN.Profile(profile):
+                        # every call starts from an empty array cache
+                        elapsed = TimeCall(func, snap, repeat=repeat,
+                                           setup=lambda: AC.ClearCache(AC.CacheDir(snap)))
+                finally:
+                    if quiet:
+                        sys.stdout.close()
+                        sys.stdout = stdout
+                results.append({'entry_point': name, 'nHalo': counts['nHalo'],
+                                'nSub': counts['nSub'], 'nPart': counts['nPart'],
+                                'seconds': elapsed,
+                                'per_host': elapsed/max(counts['nHalo'], 1),
+                                'per_subhalo': elapsed/max(counts['nSub'], 1)})
+                results[-1].update(IN.Report())
+                print('{:20s} nHalo={:<9d} {:9.4f} s  {:9.3e} s/host  {:9.3e} s/subhalo'.format(
+                    name, nHalo, elapsed, results[-1]['per_host'], results[-1]['per_subhalo']))
+    finally:
+        os.chdir(cwd)
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def Regressions(results, baseline, tolerance=1.5):
+    # entries whose time per host grew by more than `tolerance` times
+    previous = {(r['entry_point'], r['nHalo']): r for r in baseline}
+    slower = []
+    for r in results:
+        old = previous.get((r['entry_point'], r['nHalo']))
+        if old is not None and r['per_host'] > tolerance*old['per_host']:
+            slower.append((r['entry_point'], r['nHalo'], old['per_host'], r['per_host']))
+    return slower
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the halo catalogue analyses on mock catalogues.')
+    parser.add_argument('sizes', nargs='*', type=int, default=[1000, 10000], help='host counts')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--occupancy', type=float, default=1.5, help='mean subhalos per host')
+    parser.add_argument('--nPart_max', type=int, default=10**4)
+    parser.add_argument('--out', help='write results as JSON')
+    parser.add_argument('--baseline', help='JSON from an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    parser.add_argument('--profile', help='directory for one cProfile dump per entry point')
+    args = parser.parse_args()
+
+    profile_dir = None
+    if args.profile:
+        profile_dir = os.path.abspath(args.profile)
+        os.makedirs(profile_dir, exist_ok=True)
+    results = Benchmark(args.sizes, args.repeat, profile_dir=profile_dir,
+                        occupancy=args.occupancy, nPart_max=args.nPart_max)
+    if args.out:
+        with open(args.out, 'w') as out:
+            json.dump(results, out, indent=1)
+    if args.baseline:
+        with open(args.baseline) as old:
+            slower = Regressions(results, json.load(old), args.tolerance)
+        for name, nHalo, before, after in slower:
+            print('REGRESSION', name, 'nHalo='+str(nHalo), '{:.3e} -> {:.3e} s/host'.format(before, after))
+        if slower:
+            sys.exit(1)
@@ -0,0 +1,109 @@
+import multiprocessing
+import numpy as np
+import OccupancyIndex as OI
+import HaloHist as HH
+
+# Host-resampling bootstrap of the occupancy-split density histograms.
+#
+# The values are binned once into per-host counts, with the BinIndex of
+# the plotted HH.FixedHistogram so both put edge values in the same bin,
+# kept as sparse
+# (host, bin, count) triplets.  A bootstrap sample draws N of the N
+# selected hosts with replacement and counts how often each is drawn;
+# hosts that contribute no in-range values only enter through that draw,
+# so they share one slot and just the K contributing hosts get a weight.
+# The resampled histograms of a block of samples are then one weighted
+# bincount over the triplets.  Blocks are spread over a process pool, each
+# with its own seed from SeedSequence(seed).spawn, so the result does not
+# depend on nproc.
+#
+# Densities are normalised like HH.FixedHistogram.Density (in-range counts
+# only) and the band is the central `confidence` interval of the samples.
+
+DEFAULT_RESAMPLES = 1000
+BLOCK_RESAMPLES = 64
+BLOCK_ELEMENTS = 2**24
+
+def HostBinTriplets(values, host, hist):
+    # sparse per-host counts of the values in the bins of hist;
+    # hosts relabelled 0..K-1
+    values = np.asarray(values, dtype=np.float64)
+    host = np.asarray(host, dtype=np.int64)
+    bins = hist.bins
+    keep = ~np.isnan(values)
+    values = values[keep]
+    host = host[keep]
+    b = hist.BinIndex(values)
+    inside = (b >= 0) & (b < bins)
+    pair, count = np.unique(host[inside]*bins + b[inside], return_counts=True)
+    hosts, trip_host = np.unique(pair//bins, return_inverse=True)
+    return trip_host, pair % bins, count, len(hosts)
+
+_triplets = None
+
+def InitWorker(triplets):
+    global _triplets
+    _triplets = triplets
+
+def ResampleBlock(args):
+    seed, n_resample, nHost = args
+    trip_host, trip_bin, trip_count, K, bins = _triplets
+    rng = np.random.default_rng(seed)
+    # hosts K..nHost-1 contribute nothing: pool their draws in slot K
+    draws = np.minimum(rng.integers(0, nHost, size=(n_resample, nHost)), K)
+    draws += np.arange(n_resample)[:, None]*(K+1)
+    weights = np.bincount(draws.ravel(), minlength=n_resample*(K+1)).reshape(n_resample, K+1)[:, :K]
+    flat = (np.arange(n_resample)[:, None]*bins + trip_bin[None, :]).ravel()
+    counts = np.bincount(flat, weights=(weights[:, trip_host]*trip_count).ravel(),
+                         minlength=n_resample*bins)
+    return counts.reshape(n_resample, bins)
+
+def BootstrapCounts(values, host, nHost, hist, n_resample=None, seed=0, nproc=1):
+    # (n_resample, bins) histograms of the values of nHost hosts drawn with replacement
+    if n_resample is None:
+        n_resample = DEFAULT_RESAMPLES
+    trip_host, trip_bin, trip_count, K = HostBinTriplets(values, host, hist)
+    bins = hist.bins
+    if K == 0 or nHost == 0:
+        return np.zeros((n_resample, bins))
+    triplets = (trip_host, trip_bin, trip_count, K, bins)
+
+    # fixed block sizes, so the seeds (and results) do not depend on nproc
+    block = int(max(1, min(BLOCK_RESAMPLES, BLOCK_ELEMENTS//max(len(trip_bin), nHost, 1))))
+    sizes = [min(block, n_resample - a) for a in range(0, n_resample, block)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(s, n, nHost) for s, n in zip(seeds, sizes)]
+    if nproc > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(nproc, len(tasks)), initializer=InitWorker, initargs=(triplets,)) as pool:
+            parts = pool.map(ResampleBlock, tasks)
+    else:
+        InitWorker(triplets)
+        parts = [ResampleBlock(task) for task in tasks]
+    return np.concatenate(parts)
+
+def DensityBand(counts, edges, confidence=0.68):
+    # central interval and standard deviation of resampled densities
+    total = np.sum(counts, axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        density = np.where(total > 0, counts/(total*np.diff(edges)), 0)
+    q = 50*(1 - confidence)
+    lower, upper = np.percentile(density, [q, 100 - q], axis=0)
+    return {'lower': lower, 'upper': upper, 'std': np.std(density, axis=0), 'confidence': confidence}
+
+def OccupancyBands(values, nsub, host, nHaloSub, occupancies, hist, n_resample=None,
+                   confidence=0.68, seed=0, nproc=1):
+    # one band per occupancy range, in the bins of the HH.FixedHistogram hist;
+    # values, nsub and host are per subhalo, nHaloSub per host (for the
+    # number of selected hosts to draw)
+    bands = []
+    for k, (occupancy_l, occupancy_h) in enumerate(occupancies):
+        select = OI.SelectHosts(nsub, occupancy_l, occupancy_h)
+        nHost = int(np.count_nonzero(OI.SelectHosts(nHaloSub, occupancy_l, occupancy_h)))
+        counts = BootstrapCounts(values[select], host[select], nHost, hist, n_resample, seed+k, nproc)
+        bands.append(DensityBand(counts, hist.edges, confidence))
+    return bands
+
+def SubhaloHosts(halo_snapshot):
+    # host row of every subhalo and the occupancy of every host
+    nHaloSub, sub_offset = OI.LoadIndex(halo_snapshot)
+    return np.repeat(np.arange(len(nHaloSub)), np.diff(sub_offset)), nHaloSub
@@ -0,0 +1,277 @@
+import operator
+import numpy as np
+import h5py
+import HaloSummary as HS
+import OccupancyIndex as OI
+import Instrument as IN
+
+# Lazy query interface over the summary sidecar of a halos_XXX.hdf5
+# catalogue.  Columns are named per table:
+#   hosts: nPart, nsub, radius (Halo_Pos), speed (Halo_Vel), sigma,
+#          sigma_tensor
+#   subs:  nPart, mean_pos, mean_vel, and host.<host column> for the
+#          value of the subhalo's host
+# plus 'row' (row in the table) and, for subs, 'host_row'.
+#
+# Comparisons of columns build predicates; nothing is read until Read or
+# Count.  The scan goes over chunks of hosts and pushes the filters and
+# the projection down to the sidecar:
+#   - the conjuncts of Where are evaluated one after the other, each
+#     reading its columns only for the rows still selected, host
+#     predicates before subhalo predicates;
+#   - chunks where no host survives stop there;
+#   - only the selected columns of the surviving rows are read, as runs
+#     of nearby rows (gaps up to READ_GAP rows are read through), and a
+#     column read for a filter is not read again for the same chunk.
+#
+#   cat = CA.Catalogue('halos_061.hdf5')
+#   subs = cat.subs.Where(cat.hosts.nsub.Between(2, 4), cat.subs.nPart >= 100)
+#   data = subs.Read('mean_pos', 'host.radius')
+#   largest = cat.subs.Where(cat.subs.nPart >= 10000).nPart.Read()
+
+DEFAULT_CHUNK_HOSTS = 2**18
+READ_GAP = 256
+
+HOST_FIELDS = {'nPart': 'halo_nPart', 'nsub': 'nHaloSub', 'radius': 'Halo_Pos', 'speed': 'Halo_Vel',
+               'sigma': 'Sigma', 'sigma_tensor': 'Sigma_tensor'}
+SUB_FIELDS = {'nPart': 'subhalo_nPart', 'mean_pos': 'subhalo_mean_pos', 'mean_vel': 'subhalo_mean_vel'}
+TABLE_FIELDS = {'hosts': HOST_FIELDS, 'subs': SUB_FIELDS}
+
+def ReadRows(ds, rows, gap=READ_GAP):
+    # ds[rows] for sorted rows, read as runs of nearby rows
+    if len(rows) == 0:
+        return np.zeros((0,) + ds.shape[1:], dtype=ds.dtype)
+    breaks = np.flatnonzero(np.diff(rows) > gap) + 1
+    starts = rows[np.concatenate([[0], breaks])]
+    stops = rows[np.concatenate([breaks - 1, [len(rows) - 1]])] + 1
+    data = np.concatenate([ds[a:b] for a, b in zip(starts, stops)])
+    IN.Count('hdf5_objects', len(starts))
+    IN.Count('bytes_read', data.nbytes)
+    base = np.concatenate([[0], np.cumsum(stops - starts)[:-1]])
+    run = np.repeat(np.arange(len(starts)), np.diff(np.concatenate([[0], breaks, [len(rows)]])))
+    return data[rows - starts[run] + base[run]]
+
+class Predicate:
+    # op is a comparison (column, operator, value) or '&', '|', '~' of predicates
+    def __init__(self, op, args):
+        self.op = op
+        self.args = args
+
+    def __and__(self, other):
+        return Predicate('&', (self, other))
+
+    def __or__(self, other):
+        return Predicate('|', (self, other))
+
+    def __invert__(self):
+        return Predicate('~', (self,))
+
+    def Columns(self):
+        if self.op == 'cmp':
+            return [self.args[0]]
+        return [column for arg in self.args for column in arg.Columns()]
+
+    def Evaluate(self, values):
+        # values: column key -> array over the rows being filtered
+        if self.op == 'cmp':
+            column, compare, value = self.args
+            return compare(values[column.Key()], value)
+        if self.op == '&':
+            return self.args[0].Evaluate(values) & self.args[1].Evaluate(values)
+        if self.op == '|':
+            return self.args[0].Evaluate(values) | self.args[1].Evaluate(values)
+        return ~self.args[0].Evaluate(values)
+
+class Column:
+    def __init__(self, query, table, field):
+        if field not in TABLE_FIELDS[table]:
+            raise AttributeError('no {} column {!r}'.format(table, field))
+        self.query = query
+        self.table = table
+        self.field = field
+        self.dataset = TABLE_FIELDS[table][field]
+
+    def Key(self):
+        return (self.table, self.dataset)
+
+    def Name(self):
+        # name in the query's table: subhalo columns of hosts are host.<field>
+        if self.table == 'hosts' and self.query.table == 'subs':
+            return 'host.' + self.field
+        return self.field
+
+    def Compare(self, compare, value):
+        return Predicate('cmp', (self, compare, value))
+
+    def __lt__(self, value):
+        return self.Compare(operator.lt, value)
+
+    def __le__(self, value):
+        return self.Compare(operator.le, value)
+
+    def __gt__(self, value):
+        return self.Compare(operator.gt, value)
+
+    def __ge__(self, value):
+        return self.Compare(operator.ge, value)
+
+    def __eq__(self, value):
+        return self.Compare(operator.eq, value)
+
+    def __ne__(self, value):
+        return self.Compare(operator.ne, value)
+
+    __hash__ = None
+
+    def Between(self, low, high):
+        # low <= column <= high, as OI.SelectHosts
+        return (self >= low) & (self <= high)
+
+    def IsIn(self, values):
+        return self.Compare(lambda x, v: np.isin(x, v), np.asarray(values))
+
+    def Read(self):
+        return self.query.Read(self.Name())[self.Name()]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.Read(), dtype=dtype)
+
+class HostColumns:
+    # host.<field> of a subhalo query
+    def __init__(self, query):
+        self.query = query
+
+    def __getattr__(self, field):
+        return Column(self.query, 'hosts', field)
+
+class Query:
+    def __init__(self, catalogue, table, predicates=()):
+        self.catalogue = catalogue
+        self.table = table
+        self.predicates = tuple(predicates)
+
+    def __getattr__(self, field):
+        if field == 'host' and self.table == 'subs':
+            return HostColumns(self)
+        if field in TABLE_FIELDS[self.table]:
+            return Column(self, self.table, field)
+        raise AttributeError(field)
+
+    def Where(self, *predicates):
+        for predicate in predicates:
+            for column in predicate.Columns():
+                if column.table == 'subs' and self.table == 'hosts':
+                    raise ValueError('host query filtered on subhalo column ' + column.field)
+        return Query(self.catalogue, self.table, self.predicates + predicates)
+
+    def Resolve(self, name):
+        # Column for a name of this table ('nPart', 'host.radius') or a Column
+        if isinstance(name, Column):
+            return name
+        if name.startswith('host.') and self.table == 'subs':
+            return Column(self, 'hosts', name[5:])
+        return Column(self, self.table, name)
+
+    def Scan(self, names, chunk_hosts=None):
+        # one dict of the named columns per chunk of hosts with selected rows
+        if chunk_hosts is None:
+            chunk_hosts = self.catalogue.chunk_hosts
+        columns = {name: self.Resolve(name) for name in names if name not in ('row', 'host_row')}
+        host_conjuncts = [p for p in self.predicates if all(c.table == 'hosts' for c in p.Columns())]
+        sub_conjuncts = [p for p in self.predicates if p not in host_conjuncts]
+
+        with h5py.File(self.catalogue.summary_file, 'r') as s:
+            sub_offset = s['sub_offset'][()]
+            nHalo = len(sub_offset) - 1
+            for a in range(0, nHalo, chunk_hosts):
+                b = min(a + chunk_hosts, nHalo)
+                known = {}
+                with IN.Phase('query:filter'):
+                    hosts = np.arange(a, b)
+                    for predicate in host_conjuncts:
+                        values = {c.Key(): self.Fetch(s, c, hosts, known) for c in predicate.Columns()}
+                        hosts = hosts[predicate.Evaluate(values)]
+                    if len(hosts) == 0:
+                        continue
+                    if self.table == 'hosts':
+                        rows = hosts
+                        host_row = hosts
+                    else:
+                        nsub = sub_offset[hosts+1] - sub_offset[hosts]
+                        host_row = np.repeat(hosts, nsub)
+                        rows = OI.SubRows(sub_offset, hosts)
+                        for predicate in sub_conjuncts:
+                            values = {c.Key(): self.Values(s, c, rows, host_row, known) for c in predicate.Columns()}
+                            keep = predicate.Evaluate(values)
+                            rows = rows[keep]
+                            host_row = host_row[keep]
+                    if len(rows) == 0:
+                        continue
+                with IN.Phase('query:read'):
+                    chunk = {name: self.Values(s, c, rows, host_row, known) for name, c in columns.items()}
+                    if 'row' in names:
+                        chunk['row'] = rows
+                    if 'host_row' in names:
+                        chunk['host_row'] = host_row
+                yield chunk
+
+    def Fetch(self, s, column, rows, known):
+        # column at sorted rows; rows already read for this chunk are not read again
+        key = column.Key()
+        if key in known:
+            known_rows, values = known[key]
+            index = np.minimum(np.searchsorted(known_rows, rows), len(known_rows) - 1)
+            if np.array_equal(known_rows[index], rows):
+                return values[index]
+        values = ReadRows(s[column.dataset], rows)
+        known[key] = (rows, values)
+        return values
+
+    def Values(self, s, column, rows, host_row, known):
+        # column on the rows of this query's table; host columns of subhalo
+        # rows are read once per host and broadcast
+        if column.table == self.table:
+            return self.Fetch(s, column, rows, known)
+        hosts, index = np.unique(host_row, return_inverse=True)
+        return self.Fetch(s, column, hosts, known)[index]
+
+    def Read(self, *names, chunk_hosts=None):
+        # selected rows of the named columns, concatenated over the chunks
+        if not names:
+            names = list(TABLE_FIELDS[self.table])
+        names = [c.Name() if isinstance(c, Column) else c for c in names]
+        parts = {name: [] for name in names}
+        for chunk in self.Scan(names, chunk_hosts):
+            for name in names:
+                parts[name].append(chunk[name])
+        data = {}
+        for name in names:
+            if parts[name]:
+                data[name] = np.concatenate(parts[name])
+            elif name in ('row', 'host_row'):
+                data[name] = np.zeros(0, dtype=np.int64)
+            else:
+                data[name] = self.catalogue.Empty(self.Resolve(name))
+        return data
+
+    def Count(self):
+        return sum(len(chunk['row']) for chunk in self.Scan(['row']))
+
+class Catalogue:
+    def __init__(self, halo_snapshot, summary_file=None, chunk_hosts=None, nproc=1):
+        if summary_file is None:
+            summary_file = HS.SummaryPath(halo_snapshot)
+        if not HS.IsFresh(halo_snapshot, summary_file):
+            HS.ExtractSummary(halo_snapshot, summary_file, nproc=nproc)
+        if chunk_hosts is None:
+            chunk_hosts = DEFAULT_CHUNK_HOSTS
+        self.halo_snapshot = halo_snapshot
+        self.summary_file = summary_file
+        self.chunk_hosts = chunk_hosts
+        self.hosts = Query(self, 'hosts')
+        self.subs = Query(self, 'subs')
+
+    def Empty(self, column):
+        with h5py.File(self.summary_file, 'r') as s:
+            ds = s[column.dataset]
+            return np.zeros((0,) + ds.shape[1:], dtype=ds.dtype)
@@ -0,0 +1,242 @@
+import multiprocessing
+import numpy as np
+import h5py
+import SpatialIndex as SI
+import Instrument as IN
+
+# Friends-of-friends groups of a particle snapshot, written as a
+# halos_XXX.hdf5 catalogue (layout in MockCatalogue): hosts are the groups
+# at linking length b_host (0.2 of the mean interparticle separation), and
+# the subhalos of a host are the groups at b_sub (0.1) among its particles.
+# Every pair closer than b_sub is also closer than b_host, so each 0.1
+# group lies inside one 0.2 group and both levels are found over the
+# whole box.
+#
+# Pairs closer than the linking length come from a periodic cell list
+# (SpatialIndex.CellList) with cells of about one linking length at any
+# particle count (only occupied cells are stored); each pair of
+# neighbouring cells is visited once (half shell).  Centres go in cell
+# order, in batches sized by the number of candidate pairs in their
+# neighbour cells, so dense halos do not blow up memory.
+# The batches are spread over a process pool; each worker merges its
+# pairs into a union-find forest and returns only the forest links, which
+# are merged once more for the final groups.
+#
+# Groups are numbered by decreasing particle count.  Particle positions are
+# stored unwrapped around the first member of their host, so groups
+# crossing a box face stay in one piece and the means are meaningful.
+#
+#   groups = FOF.FindHalos(Pos, Vel, box_size=100.0, nproc=8)
+#   FOF.WriteCatalogue('halos_061.hdf5', Pos, Vel, groups)
+
+B_HOST = 0.2
+B_SUB = 0.1
+HOST_NPART_MIN = 20
+SUB_NPART_MIN = 10
+PAIR_BUDGET = 2**22
+
+def LinkingLength(b, nPart, box_size):
+    # b times the mean interparticle separation
+    return b*box_size/np.cbrt(max(nPart, 1))
+
+def Components(i, j, n):
+    # connected-component label of every node, the smallest node of its
+    # component: hooking of roots along the edges plus pointer jumping
+    labels = np.arange(n, dtype=np.int64)
+    i = np.asarray(i, dtype=np.int64)
+    j = np.asarray(j, dtype=np.int64)
+    while len(i):
+        li = labels[i]
+        lj = labels[j]
+        differ = li != lj
+        i, j, li, lj = i[differ], j[differ], li[differ], lj[differ]
+        if not len(i):
+            break
+        np.minimum.at(labels, np.maximum(li, lj), np.minimum(li, lj))
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+    return labels
+
+def HalfShifts(cells, r):
+    # neighbour-cell shifts with each pair of cells visited once: the zero
+    # shift and one of every +-shift, unless the shifts wrap the whole box
+    shifts = cells.Shifts(r)
+    span = int(np.ceil(r/cells.cell_size))
+    if 2*span + 1 >= cells.ncell:
+        return shifts, False
+    # keep the shifts whose first non-zero component is positive
+    lead = shifts[np.arange(len(shifts)), np.argmax(shifts != 0, axis=1)]
+    return shifts[lead >= 0], True
+
+def NeighbourCounts(cells, shifts):
+    # candidate pairs of every occupied cell (particles in all its shifted
+    # cells), with the occupied cells in cell order
+    counts = np.diff(cells.cell_offset)
+    coords = cells.OccupiedCoords()
+    total = np.zeros(len(counts), dtype=np.int64)
+    for shift in shifts:
+        total += cells.CellRange(cells.Key(np.mod(coords + shift, cells.ncell)))[1]
+    return total, counts
+
+def LinkPairs(cells, rows, r, shifts):
+    # pairs (i, j), i < j for pairs in one cell, of rows and indexed points closer than r
+    coords = cells.CellCoords(cells.positions[rows])
+    centres = cells.positions[rows]
+    parts_i = []
+    parts_j = []
+    for shift in shifts:
+        owner, index = cells.Gather(coords, shift)
+        if len(index) == 0:
+            continue
+        d = SI.PeriodicDelta(centres[owner], cells.positions[index], cells.box_size)
+        keep = np.einsum('ij,ij->i', d, d) <= r*r
+        if not np.any(shift):
+            keep &= rows[owner] < index
+        parts_i.append(rows[owner[keep]])
+        parts_j.append(index[keep])
+    i = np.concatenate(parts_i) if parts_i else np.zeros(0, dtype=np.int64)
+    j = np.concatenate(parts_j) if parts_j else np.zeros(0, dtype=np.int64)
+    return i, j
+
+def PlanCentreBatches(cells, shifts, pair_budget):
+    # ranges of cell-sorted rows [a, b) whose candidate pairs fit the budget
+    total, occupancy = NeighbourCounts(cells, shifts)
+    cum = np.concatenate([[0], np.cumsum(np.repeat(total, occupancy))])
+    nPart = len(cum) - 1
+    batches = []
+    a = 0
+    while a < nPart:
+        b = int(np.searchsorted(cum, cum[a] + pair_budget, side='right')) - 1
+        b = min(max(b, a+1), nPart)
+        batches.append((a, b))
+        a = b
+    return batches
+
+_cells = None
+
+def InitWorker(cells):
+    global _cells
+    _cells = cells
+
+def LinkBatches(args):
+    # union-find forest of all pairs with a centre in the batches of cell-sorted rows
+    batches, r, shifts, half = args
+    cells = _cells
+    parts_i = []
+    parts_j = []
+    for a, b in batches:
+        i, j = LinkPairs(cells, cells.order[a:b], r, shifts)
+        if not half:
+            # every cell is visited from both sides: keep each pair once
+            keep = i < j
+            i, j = i[keep], j[keep]
+        parts_i.append(i)
+        parts_j.append(j)
+    i = np.concatenate(parts_i) if parts_i else np.zeros(0, dtype=np.int64)
+    j = np.concatenate(parts_j) if parts_j else np.zeros(0, dtype=np.int64)
+    nodes, local = np.unique(np.concatenate([i, j]), return_inverse=True)
+    labels = Components(local[:len(i)], local[len(i):], len(nodes))
+    linked = labels != np.arange(len(nodes))
+    return nodes[linked], nodes[labels[linked]]
+
+def FriendsOfFriends(positions, box_size, r, min_nPart, nproc=1, pair_budget=None):
+    # group of every particle (-1 below min_nPart), groups by decreasing size
+    if pair_budget is None:
+        pair_budget = PAIR_BUDGET
+    nPart = len(positions)
+    with IN.Phase('fof:index'):
+        cells = SI.CellList(positions, box_size, cell_size=r)
+        shifts, half = HalfShifts(cells, r)
+        batches = PlanCentreBatches(cells, shifts, pair_budget)
+    # a few tasks per worker, each a run of neighbouring batches
+    split = np.array_split(np.arange(len(batches)), max(1, min(4*nproc, len(batches))))
+    tasks = [([batches[k] for k in part], r, shifts, half) for part in split if len(part)]
+    with IN.Phase('fof:link'):
+        if nproc > 1 and len(tasks) > 1:
+            with multiprocessing.Pool(min(nproc, len(tasks)), initializer=InitWorker, initargs=(cells,)) as pool:
+                forests = pool.map(LinkBatches, tasks)
+        else:
+            InitWorker(cells)
+            forests = [LinkBatches(task) for task in tasks]
+    with IN.Phase('fof:merge'):
+        i = np.concatenate([forest[0] for forest in forests]) if forests else np.zeros(0, dtype=np.int64)
+        j = np.concatenate([forest[1] for forest in forests]) if forests else np.zeros(0, dtype=np.int64)
+        labels = Components(i, j, nPart)
+        return GroupIndex(labels, min_nPart)
+
+def GroupIndex(labels, min_nPart):
+    # renumber components with at least min_nPart members 0.. by decreasing size
+    counts = np.bincount(labels, minlength=len(labels))
+    roots = np.flatnonzero(counts >= min_nPart)
+    roots = roots[np.argsort(-counts[roots], kind='stable')]
+    group = np.full(len(counts), -1, dtype=np.int64)
+    group[roots] = np.arange(len(roots))
+    return group[labels]
+
+def FindHalos(Pos, Vel, box_size, b_host=B_HOST, b_sub=B_SUB, host_nPart_min=HOST_NPART_MIN,
+              sub_nPart_min=SUB_NPART_MIN, nproc=1, pair_budget=None):
+    Pos = np.mod(np.asarray(Pos, dtype=np.float64), box_size)
+    nPart = len(Pos)
+    host = FriendsOfFriends(Pos, box_size, LinkingLength(b_host, nPart, box_size), host_nPart_min, nproc, pair_budget)
+    members = np.flatnonzero(host >= 0)
+    sub = np.full(nPart, -1, dtype=np.int64)
+    sub[members] = FriendsOfFriends(Pos[members], box_size, LinkingLength(b_sub, nPart, box_size),
+                                    sub_nPart_min, nproc, pair_budget)
+    print('nHalo:', int(np.max(host, initial=-1)) + 1)
+    print('nSub:', int(np.max(sub, initial=-1)) + 1)
+    return {'host': host, 'sub': sub, 'box_size': float(box_size)}
+
+def GroupRows(group):
+    # members of group g are rows[offset[g]:offset[g+1]]
+    select = np.flatnonzero(group >= 0)
+    rows = select[np.argsort(group[select], kind='stable')]
+    offset = np.zeros(int(np.max(group, initial=-1)) + 2, dtype=np.int64)
+    np.cumsum(np.bincount(group[select], minlength=len(offset)-1), out=offset[1:])
+    return rows, offset
+
+def WriteCatalogue(halo_snapshot, Pos, Vel, groups):
+    box_size = groups['box_size']
+    Pos = np.asarray(Pos, dtype=np.float64)
+    Vel = np.asarray(Vel, dtype=np.float64)
+    host_rows, host_offset = GroupRows(groups['host'])
+    sub_rows, sub_offset = GroupRows(groups['sub'])
+    nHalo = len(host_offset) - 1
+    # row of every host member within its host
+    rank = np.zeros(len(Pos), dtype=np.int64)
+    rank[host_rows] = np.arange(len(host_rows)) - np.repeat(host_offset[:-1], np.diff(host_offset))
+    # host of every subhalo; subhalos are already in decreasing size within a host
+    sub_host = groups['host'][sub_rows[sub_offset[:-1]]]
+    order = np.argsort(sub_host, kind='stable')
+    first_sub = np.searchsorted(sub_host[order], np.arange(nHalo+1))
+
+    with h5py.File(halo_snapshot, 'w') as f:
+        f['Halo_IDs'] = np.arange(nHalo, dtype=np.int64)
+        progress = IN.Progress('write halos', nHalo)
+        for i in range(0, nHalo):
+            rows = host_rows[host_offset[i]:host_offset[i+1]]
+            Pos_Halo = Pos[rows[0]] + SI.PeriodicDelta(Pos[rows[0]], Pos[rows], box_size)
+            Vel_Halo = Vel[rows]
+            halo = f.create_group(str(i))
+            halo.attrs['halo_nPart'] = len(rows)
+            halo['Halo_Pos'] = Pos_Halo.astype(np.float32)
+            halo['Halo_Vel'] = Vel_Halo.astype(np.float32)
+            halo['mean_vel'] = np.mean(Vel_Halo, axis=0).astype(np.float32)
+
+            # subhalo means in the host's unwrapped frame
+            for j, s in enumerate(order[first_sub[i]:first_sub[i+1]]):
+                members = rank[sub_rows[sub_offset[s]:sub_offset[s+1]]]
+                sub = halo.create_group(str(j))
+                sub.attrs['subhalo_nPart'] = len(members)
+                sub['subhalo_mean_pos'] = np.mean(Pos_Halo[members], axis=0).astype(np.float32)
+                sub['subhalo_mean_vel'] = np.mean(Vel_Halo[members], axis=0).astype(np.float32)
+            progress.Update(i+1)
+
+    return {'nHalo': nHalo, 'nSub': len(sub_offset) - 1, 'nPart': int(host_offset[-1])}
+
+def RunFOF(halo_snapshot, Pos, Vel, box_size, nproc=1, **fof_args):
+    groups = FindHalos(Pos, Vel, box_size, nproc=nproc, **fof_args)
+    with IN.Phase('write'):
+        return WriteCatalogue(halo_snapshot, Pos, Vel, groups)
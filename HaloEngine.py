@@ -0,0 +1,140 @@
+import os
+import numpy as np
+import h5py
+import HaloSummary as HS
+import HaloStream as HSt
+import Instrument as IN
+
+# Single traversal of a catalogue feeding many analyses.
+#
+# An analysis registers as an accumulator: an object with
+#   columns         summary columns it needs (see HaloSummary)
+#   Update(chunk)   called once per host chunk, in host order
+#   Finish()        called after the last chunk; returns the analysis result
+# A chunk holds the requested columns for hosts [first, last); its
+# sub_offset is local, so HS.SubHost(chunk) gives the chunk-local host of
+# every subhalo row.
+#
+# If the summary sidecar is fresh the chunks are bulk slices of it.
+# Otherwise the raw catalogue is streamed once, the sidecar is written on
+# the way (under HS.TempPath until the last batch) and the same batches
+# feed the accumulators; with nproc > 1 the sidecar is instead built first
+# by HS.ExtractSummary on a pool of nproc workers and then sliced.  Either
+# way the next chunks are read on a background thread (HSt.Prefetch)
+# during Update.
+#
+# Summary chunks are sized from the memory budget like the streamed
+# batches: the bytes of the requested host and subhalo columns of a chunk
+# stay within memory_budget // HSt.LiveBatches(prefetch), as that many
+# chunks are held at once.  chunk_hosts optionally caps the hosts per chunk.
+
+def Columns(accumulators):
+    columns = []
+    for acc in accumulators:
+        for key in acc.columns:
+            if key not in columns:
+                columns.append(key)
+    return columns
+
+def SliceChunk(s, columns, sub_offset, a, b):
+    s0, s1 = sub_offset[a], sub_offset[b]
+    chunk = {'first': a, 'last': b, 'sub_offset': sub_offset[a:b+1] - s0}
+    for key in columns:
+        if key in HS.SUB_COLUMNS:
+            chunk[key] = s[key][s0:s1]
+        else:
+            chunk[key] = s[key][a:b]
+        IN.Count('hdf5_objects')
+        IN.Count('bytes_read', chunk[key].nbytes)
+    return chunk
+
+def RowBytes(dataset):
+    return dataset.dtype.itemsize*int(np.prod(dataset.shape[1:]))
+
+def PlanChunks(sub_offset, host_bytes, sub_bytes, memory_budget, chunk_hosts=None):
+    # host ranges [a, b) whose column bytes fit the budget; a host whose
+    # subhalos alone exceed it gets a chunk of its own
+    nHalo = len(sub_offset) - 1
+    cum = host_bytes*np.arange(nHalo+1, dtype=np.int64) + sub_bytes*(sub_offset - sub_offset[0])
+    bounds = [0]
+    while bounds[-1] < nHalo:
+        a = bounds[-1]
+        b = max(int(np.searchsorted(cum, cum[a] + memory_budget, side='right')) - 1, a + 1)
+        if chunk_hosts is not None:
+            b = min(b, a + chunk_hosts)
+        bounds.append(min(b, nHalo))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def SummaryChunks(summary_file, columns, memory_budget=None, chunk_hosts=None, prefetch=None):
+    if prefetch is None:
+        prefetch = HSt.DEFAULT_PREFETCH
+    if memory_budget is None:
+        memory_budget = HSt.DEFAULT_MEMORY_BUDGET
+    memory_budget //= HSt.LiveBatches(prefetch)
+    with h5py.File(summary_file, 'r') as s:
+        sub_offset = s['sub_offset'][()]
+        host_bytes = sum(RowBytes(s[key]) for key in columns if key not in HS.SUB_COLUMNS)
+        sub_bytes = sum(RowBytes(s[key]) for key in columns if key in HS.SUB_COLUMNS)
+        # the local sub_offset of every chunk
+        host_bytes += sub_offset.dtype.itemsize
+        for a, b in PlanChunks(sub_offset, host_bytes, sub_bytes, memory_budget, chunk_hosts):
+            with IN.Phase('read'):
+                chunk = SliceChunk(s, columns, sub_offset, a, b)
+            yield chunk
+
+def StreamChunks(halo_snapshot, summary_file, memory_budget=None):
+    with h5py.File(HS.TempPath(summary_file), 'w') as s:
+        HS.CreateSummary(s, halo_snapshot)
+        with HSt.OpenSnapshot(halo_snapshot) as f:
+            progress = IN.Progress('summary', HSt.CountHosts(f))
+        for batch in HSt.IterHostBatches(halo_snapshot, memory_budget):
+            with IN.Phase('reduce'):
+                chunk = HS.SummarizeBatch(batch)
+            with IN.Phase('write'):
+                HS.AppendSummary(s, chunk)
+            progress.Update(batch['last'])
+            chunk['first'] = batch['first']
+            chunk['last'] = batch['last']
+            chunk['sub_offset'] = batch['sub_offset']
+            yield chunk
+        HS.FinishSummary(s)
+    os.replace(HS.TempPath(summary_file), summary_file)
+
+class CollectAcc:
+    # concatenates the per-chunk arrays returned by func(chunk) over the
+    # whole catalogue; Finish gives them as a dict under `names`
+    def __init__(self, func, columns, names):
+        self.func = func
+        self.columns = columns
+        self.names = names
+        self.parts = [[] for name in names]
+
+    def Update(self, chunk):
+        for part, array in zip(self.parts, self.func(chunk)):
+            part.append(array)
+
+    def Finish(self):
+        return {name: np.concatenate(part) if part else np.zeros(0)
+                for name, part in zip(self.names, self.parts)}
+
+def Traverse(halo_snapshot, accumulators, summary_file=None, memory_budget=None, chunk_hosts=None, nproc=1):
+    if summary_file is None:
+        summary_file = HS.SummaryPath(halo_snapshot)
+    if nproc > 1 and not HS.IsFresh(halo_snapshot, summary_file):
+        # build the sidecar on the worker pool, then read it like a fresh one
+        HS.ExtractSummary(halo_snapshot, summary_file, memory_budget, nproc=nproc)
+    if HS.IsFresh(halo_snapshot, summary_file):
+        chunks = HSt.Prefetch(SummaryChunks(summary_file, Columns(accumulators), memory_budget, chunk_hosts))
+    else:
+        chunks = StreamChunks(halo_snapshot, summary_file, memory_budget)
+
+    for chunk in chunks:
+        for acc in accumulators:
+            with IN.Phase('update:'+type(acc).__name__):
+                acc.Update(chunk)
+
+    results = []
+    for acc in accumulators:
+        with IN.Phase('finish:'+type(acc).__name__):
+            results.append(acc.Finish())
+    return results
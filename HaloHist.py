@@ -0,0 +1,113 @@
+import numpy as np
+
+# Histogram with bins fixed up front, filled incrementally.
+#
+# Only the bin counts are kept, so memory does not depend on how many
+# values are fed in.  Values outside the range are counted in underflow /
+# overflow and NaNs are dropped, matching np.histogram(values, bins, range)
+# on the NaN-filtered data.  Density normalisation is applied at the end.
+#
+# BinIndex is the one binning rule: a value goes in bin b when
+# edges[b] <= value < edges[b+1], the top edge in the last bin.  The float
+# scaling can land one bin off the linspace edges, so it is stepped back
+# onto them as np.histogram does.  EdgeIndex applies the same rule to
+# arbitrary increasing edges, for binnings that are not evenly spaced.
+#
+# LogHistogram2D does the same for (x, y) pairs on log-spaced bins: a pair
+# is dropped when either value is NaN, so x and y stay aligned, and pairs
+# outside the ranges (or not positive) are counted in `outside`.
+
+def EdgeIndex(edges, values):
+    # bin of every value for increasing edges: -1 below them, len(edges)-1 above
+    edges = np.asarray(edges, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    index = np.searchsorted(edges, values, side='right') - 1
+    index[values == edges[-1]] = len(edges) - 2
+    return index
+
+class FixedHistogram:
+    def __init__(self, bins, range):
+        self.bins = bins
+        self.range = (float(range[0]), float(range[1]))
+        self.edges = np.linspace(self.range[0], self.range[1], bins+1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+
+    def BinIndex(self, values):
+        # bin of every value: -1 below the range, bins above it
+        lo, hi = self.range
+        values = np.asarray(values, dtype=np.float64)
+        # clip before the cast: +-inf (and huge values) go to overflow/underflow
+        scaled = np.clip((values - lo)/(hi - lo)*self.bins, -1, self.bins)
+        index = np.floor(scaled).astype(np.int64)
+        inner = (index >= 0) & (index < self.bins)
+        index[inner] -= values[inner] < self.edges[index[inner]]
+        inner = (index >= 0) & (index < self.bins - 1)
+        index[inner] += values[inner] >= self.edges[index[inner] + 1]
+        index[values == hi] = self.bins - 1
+        return index
+
+    def Update(self, values):
+        values = np.asarray(values)
+        values = values[~np.isnan(values)]
+        index = self.BinIndex(values)
+        counts = np.bincount(index + 1, minlength=self.bins+2)
+        self.underflow += int(counts[0])
+        self.counts += counts[1:-1]
+        self.overflow += int(counts[-1])
+
+    def Merge(self, other):
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+
+    def Density(self):
+        total = np.sum(self.counts)
+        if total == 0:
+            return np.zeros(self.bins)
+        return self.counts/(total*np.diff(self.edges))
+
+class LogHistogram2D:
+    def __init__(self, bins, x_range, y_range):
+        if np.isscalar(bins):
+            bins = (bins, bins)
+        self.bins = tuple(bins)
+        self.x_range = (float(x_range[0]), float(x_range[1]))
+        self.y_range = (float(y_range[0]), float(y_range[1]))
+        self.x_axis = FixedHistogram(self.bins[0], np.log10(self.x_range))
+        self.y_axis = FixedHistogram(self.bins[1], np.log10(self.y_range))
+        self.x_edges = 10**self.x_axis.edges
+        self.y_edges = 10**self.y_axis.edges
+        self.counts = np.zeros(self.bins, dtype=np.int64)
+        self.outside = 0
+        self.dropped = 0
+
+    def Update(self, x, y):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        paired = ~(np.isnan(x) | np.isnan(y))
+        self.dropped += int(len(x) - np.count_nonzero(paired))
+        x = x[paired]
+        y = y[paired]
+        positive = (x > 0) & (y > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            i = self.x_axis.BinIndex(np.log10(np.where(positive, x, 1)))
+            j = self.y_axis.BinIndex(np.log10(np.where(positive, y, 1)))
+        inside = positive & (i >= 0) & (i < self.bins[0]) & (j >= 0) & (j < self.bins[1])
+        self.outside += int(len(x) - np.count_nonzero(inside))
+        flat = i[inside]*self.bins[1] + j[inside]
+        self.counts += np.bincount(flat, minlength=self.bins[0]*self.bins[1]).reshape(self.bins)
+
+    def Merge(self, other):
+        self.counts += other.counts
+        self.outside += other.outside
+        self.dropped += other.dropped
+
+    def Density(self):
+        # per unit area in (log10 x, log10 y)
+        total = np.sum(self.counts)
+        if total == 0:
+            return np.zeros(self.bins)
+        area = np.outer(np.diff(self.x_axis.edges), np.diff(self.y_axis.edges))
+        return self.counts/(total*area)
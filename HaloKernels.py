@@ -0,0 +1,105 @@
+import numpy as np
+
+# Per-host particle reductions used to scale subhalo positions and speeds:
+#   max radius of Halo_Pos, mean speed of Halo_Vel and the velocity
+#   dispersion tensor <U_a U_b> with U = Halo_Vel - mean_vel.
+# Sigma, as used by the SubHalo* plots, is the trace of that tensor.
+# SegmentedMean gives per-host means; SegmentedPeriodicMean the host
+# centres in a periodic box, for hosts that straddle a box face, and
+# SegmentedPeriodicRadius the largest particle distance from them.
+
+def ParticleNorm(X):
+    return np.sqrt(np.sum(np.square(X, dtype=np.float32), axis=1))
+
+def HostReduce(Pos_Halo, Vel_Halo, Vel_Halo_Mean=None):
+    Pos_Halo = np.asarray(Pos_Halo, dtype=np.float32)
+    Vel_Halo = np.asarray(Vel_Halo, dtype=np.float32)
+    if len(Vel_Halo) == 0:
+        return np.float32(np.nan), np.float32(np.nan), np.full((3, 3), np.nan, dtype=np.float32)
+    if Vel_Halo_Mean is None:
+        Vel_Halo_Mean = np.mean(Vel_Halo, axis=0, dtype=np.float64)
+
+    max_radius = np.max(ParticleNorm(Pos_Halo))
+    mean_speed = np.mean(ParticleNorm(Vel_Halo))
+    U = Vel_Halo - np.asarray(Vel_Halo_Mean, dtype=np.float32)
+    U = U.astype(np.float64)
+    sigma = (U.T @ U)/len(U)
+    return max_radius, mean_speed, sigma.astype(np.float32)
+
+def SegmentedHostReduce(Pos, Vel, offsets, Mean_Vel=None):
+    # Pos, Vel are the particles of many hosts stacked; host i owns rows
+    # offsets[i]:offsets[i+1]. Empty hosts come back as NaN.
+    Pos = np.asarray(Pos, dtype=np.float32)
+    Vel = np.asarray(Vel, dtype=np.float32)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    nHost = len(offsets) - 1
+    nPart = np.diff(offsets)
+    full = nPart > 0
+    starts = offsets[:-1][full]
+
+    max_radius = np.full(nHost, np.nan, dtype=np.float32)
+    mean_speed = np.full(nHost, np.nan, dtype=np.float32)
+    sigma = np.full((nHost, 3, 3), np.nan, dtype=np.float32)
+    if not np.any(full):
+        return max_radius, mean_speed, sigma
+
+    max_radius[full] = np.maximum.reduceat(ParticleNorm(Pos), starts)
+    speed_sum = np.add.reduceat(ParticleNorm(Vel).astype(np.float64), starts)
+    mean_speed[full] = speed_sum/nPart[full]
+
+    if Mean_Vel is None:
+        vel_sum = np.add.reduceat(Vel, starts, axis=0, dtype=np.float64)
+        Mean_Vel = np.zeros((nHost, 3))
+        Mean_Vel[full] = vel_sum/nPart[full, None]
+    U = Vel - np.repeat(np.asarray(Mean_Vel, dtype=np.float32), nPart, axis=0)
+    # the 6 distinct products, one column at a time, to keep temporaries small
+    UU_sum = np.empty((len(starts), 3, 3))
+    for a, b in [(0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)]:
+        UU_sum[:, a, b] = np.add.reduceat(U[:, a].astype(np.float64)*U[:, b], starts)
+        UU_sum[:, b, a] = UU_sum[:, a, b]
+    sigma[full] = UU_sum/nPart[full, None, None]
+    return max_radius, mean_speed, sigma
+
+def SegmentedMean(X, offsets):
+    # per-host mean of stacked rows; empty hosts come back as NaN
+    X = np.asarray(X)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    nPart = np.diff(offsets)
+    full = nPart > 0
+    mean = np.full((len(nPart),) + X.shape[1:], np.nan, dtype=np.float32)
+    if np.any(full):
+        total = np.add.reduceat(X.astype(np.float64), offsets[:-1][full], axis=0)
+        mean[full] = total/nPart[full].reshape((-1,) + (1,)*(X.ndim-1))
+    return mean
+
+def SegmentedPeriodicMean(X, offsets, box_size):
+    # per-host minimum-image mean: the mean offset of the rows from the host's
+    # first row, added back to it and wrapped into [0, box_size)
+    X = np.asarray(X, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    nPart = np.diff(offsets)
+    full = nPart > 0
+    ref = np.zeros((len(nPart),) + X.shape[1:])
+    ref[full] = X[offsets[:-1][full]]
+    d = X - np.repeat(ref, nPart, axis=0)
+    d -= box_size*np.round(d/box_size)
+    mean = SegmentedMean(d, offsets)
+    return np.mod(ref + mean, box_size).astype(np.float32)
+
+def SegmentedPeriodicRadius(X, offsets, centre, box_size):
+    # per-host largest minimum-image distance of the rows from the host
+    # centre; empty hosts come back as NaN
+    X = np.asarray(X, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    nPart = np.diff(offsets)
+    full = nPart > 0
+    radius = np.full(len(nPart), np.nan, dtype=np.float32)
+    if np.any(full):
+        d = X - np.repeat(np.asarray(centre, dtype=np.float64), nPart, axis=0)
+        d -= box_size*np.round(d/box_size)
+        radius[full] = np.maximum.reduceat(np.sqrt(np.sum(np.square(d), axis=1)), offsets[:-1][full])
+    return radius
+
+def Dispersion(sigma):
+    # scalar Sigma = trace of the dispersion tensor(s)
+    return np.trace(sigma, axis1=-2, axis2=-1)
@@ -0,0 +1,140 @@
+import os
+import numpy as np
+import h5py
+import HaloSummary as HS
+
+# Matching index between the 0.1 and 0.2 linking-length catalogues.
+#
+# Every 0.1 halo gets the row of its 0.2 host (host_of, -1 if unmatched)
+# and every 0.2 host the rows of its 0.1 halos as CSR (sub_offset,
+# sub_rows), so both directions are array lookups.  Halo IDs are mapped to
+# rows through IDLookup, a dense table when the IDs are compact and a
+# sorted-array search otherwise.
+#
+# The index can be built from
+#   - the /i/j nesting of a halos_XXX.hdf5 catalogue (FromCatalogue),
+#   - shared particle IDs, each 0.1 halo going to the 0.2 halo holding most
+#     of its particles (FromParticles),
+#   - explicit host IDs of the 0.1 halos (FromHostIDs).
+
+def JoinIDs(ids, table):
+    # row of every id in table (any order), -1 where missing
+    table = np.asarray(table)
+    ids = np.asarray(ids)
+    if len(table) == 0:
+        return np.full(len(ids), -1, dtype=np.int64)
+    order = np.argsort(table, kind='stable')
+    pos = np.searchsorted(table[order], ids)
+    pos[pos == len(table)] = 0
+    rows = order[pos]
+    rows[table[rows] != ids] = -1
+    return rows
+
+class IDLookup:
+    def __init__(self, ids):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.dense = None
+        if len(self.ids) and self.ids.min() >= 0 and self.ids.max() < 4*len(self.ids) + 1024:
+            self.dense = np.full(self.ids.max()+1, -1, dtype=np.int64)
+            self.dense[self.ids] = np.arange(len(self.ids))
+
+    def Rows(self, ids):
+        ids = np.atleast_1d(np.asarray(ids, dtype=np.int64))
+        if self.dense is None:
+            return JoinIDs(ids, self.ids)
+        rows = np.full(len(ids), -1, dtype=np.int64)
+        inside = (ids >= 0) & (ids < len(self.dense))
+        rows[inside] = self.dense[ids[inside]]
+        return rows
+
+class MatchIndex:
+    def __init__(self, ids_1, ids_2, host_of):
+        self.ids_1 = np.asarray(ids_1, dtype=np.int64)
+        self.ids_2 = np.asarray(ids_2, dtype=np.int64)
+        self.host_of = np.asarray(host_of, dtype=np.int64)
+        matched = np.flatnonzero(self.host_of >= 0)
+        order = matched[np.argsort(self.host_of[matched], kind='stable')]
+        counts = np.bincount(self.host_of[matched], minlength=len(self.ids_2))
+        self.sub_offset = np.zeros(len(self.ids_2)+1, dtype=np.int64)
+        np.cumsum(counts, out=self.sub_offset[1:])
+        self.sub_rows = order
+        self.lookup_1 = IDLookup(self.ids_1)
+        self.lookup_2 = IDLookup(self.ids_2)
+
+    def Host(self, ids_1):
+        # 0.2 host IDs of 0.1 halo IDs (-1 if unmatched or unknown)
+        rows = self.lookup_1.Rows(ids_1)
+        host = np.where(rows >= 0, self.host_of[np.maximum(rows, 0)], -1)
+        return np.where(host >= 0, self.ids_2[np.maximum(host, 0)], -1)
+
+    def Subs(self, id_2):
+        # 0.1 halo IDs inside one 0.2 host
+        row = self.lookup_2.Rows(id_2)[0]
+        if row < 0:
+            return np.zeros(0, dtype=np.int64)
+        return self.ids_1[self.sub_rows[self.sub_offset[row]:self.sub_offset[row+1]]]
+
+    def Save(self, path):
+        # renamed into place once written, so LoadMatch never finds half a file
+        with open(HS.TempPath(path), 'wb') as out:
+            np.savez(out, ids_1=self.ids_1, ids_2=self.ids_2, host_of=self.host_of)
+        os.replace(HS.TempPath(path), path)
+        return path
+
+def Load(path):
+    with np.load(path) as saved:
+        return MatchIndex(saved['ids_1'], saved['ids_2'], saved['host_of'])
+
+def FromHostIDs(ids_1, ids_2, host_ids_1):
+    return MatchIndex(ids_1, ids_2, JoinIDs(host_ids_1, ids_2))
+
+def FromCatalogue(halo_snapshot, ids_1=None):
+    # 0.1 halos are the rows of the flat subhalo table; 0.2 hosts carry the
+    # top-level Halo_IDs when it has one entry per host
+    summary = HS.LoadSummary(halo_snapshot, ['nHaloSub'])
+    host_of = HS.SubHost(summary)
+    nHalo = len(summary['nHaloSub'])
+    ids_2 = np.arange(nHalo)
+    with h5py.File(halo_snapshot, 'r') as f:
+        if 'Halo_IDs' in f and f['Halo_IDs'].shape == (nHalo,):
+            ids_2 = f['Halo_IDs'][()]
+    if ids_1 is None:
+        ids_1 = np.arange(len(host_of))
+    return MatchIndex(ids_1, ids_2, host_of)
+
+def FromParticles(ids_1, part_ids_1, part_offset_1, ids_2, part_ids_2, part_offset_2):
+    # halo k of catalogue n owns part_ids_n[part_offset_n[k]:part_offset_n[k+1]]
+    group_1 = np.repeat(np.arange(len(ids_1)), np.diff(part_offset_1))
+    group_2 = np.repeat(np.arange(len(ids_2)), np.diff(part_offset_2))
+    rows = JoinIDs(part_ids_1, part_ids_2)
+    shared = rows >= 0
+    g1 = group_1[shared]
+    g2 = group_2[rows[shared]]
+
+    # shared particle counts of every (0.1, 0.2) pair, then the 0.2 halo
+    # with the most shared particles for every 0.1 halo
+    pair, count = np.unique(g1*np.int64(len(ids_2)) + g2, return_counts=True)
+    p1 = pair//len(ids_2)
+    p2 = pair % len(ids_2)
+    order = np.lexsort((-count, p1))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = p1[order][1:] != p1[order][:-1]
+    best = order[first]
+    host_of = np.full(len(ids_1), -1, dtype=np.int64)
+    host_of[p1[best]] = p2[best]
+    return MatchIndex(ids_1, ids_2, host_of)
+
+def MatchPath(halo_snapshot):
+    root, ext = os.path.splitext(halo_snapshot)
+    return root + '_match.npz'
+
+def LoadMatch(halo_snapshot):
+    # nesting-based index, persisted next to the catalogue and rebuilt when
+    # the summary sidecar is
+    path = MatchPath(halo_snapshot)
+    if os.path.exists(path) and HS.IsFresh(halo_snapshot, HS.SummaryPath(halo_snapshot)) and \
+            os.path.getmtime(path) >= os.path.getmtime(HS.SummaryPath(halo_snapshot)):
+        return Load(path)
+    match = FromCatalogue(halo_snapshot)
+    match.Save(path)
+    return match
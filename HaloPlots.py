@@ -0,0 +1,245 @@
+import os
+import sys
+import multiprocessing
+import numpy as np
+
+# Render layer for the analysis results.
+#
+# The analysis modules (MassComp, SubHaloPos, SubHaloVel, SubPosVel,
+# BatchDriver) only compute; their functions and accumulators return plain
+# dicts whose 'figure' key names the renderer in RENDERERS.  matplotlib is
+# imported here on the first render, with the non-interactive Agg backend
+# unless pyplot is already loaded, so importing the analyses stays cheap.
+#
+#   HP.Render(SHP.SubHaloPos('halos_061.hdf5', 0, 1))
+#   HP.RenderAll(HE.Traverse('halos_061.hdf5', accumulators), nproc=8)
+
+PLOT_DIR = 'Plots'
+COLORS = ['r', 'g', 'b', 'c', 'm', 'y', 'k']
+
+def Pyplot():
+    if 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+def MassBand(ax, band, color):
+    # median and 16-84 percentile band of a MR.BinnedStats result
+    edges, counts, stats = band
+    centre = np.sqrt(edges[:-1]*edges[1:])
+    ax.fill_between(centre, stats[0], stats[2], color=color, alpha=0.3)
+    ax.plot(centre, stats[1], color=color)
+
+    return
+
+def DensityBand(ax, result, k, bin_edge, color):
+    # bootstrap confidence band of density k, when the result carries them
+    if result.get('bands'):
+        band = result['bands'][k]
+        ax.fill_between(bin_edge[:-1], band['lower'], band['upper'], color=color, alpha=0.3, linewidth=0)
+
+    return
+
+def SumMassComp(plt, fig, result):
+    ax = fig.add_subplot(111)
+
+    if result['band'] is not None:
+        MassBand(ax, result['band'], 'r')
+    else:
+        ax.plot(result['main_mass'], result['tot_sub_mass'],'.', color='r')
+
+    ax.grid(True)
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+
+    ax.set_title('The Sum of 0.1 Linking Lengths')
+    ax.set_xlabel(r'$M_{0.2}$')
+    ax.set_ylabel(r'$M_{0.1}$')
+
+    return 'SumMassComp.png'
+
+def MaxMassComp(plt, fig, result):
+    ax = fig.add_subplot(111)
+
+    if result['band'] is not None:
+        MassBand(ax, result['band'], 'g')
+    else:
+        ax.plot(result['main_mass'], result['max_sub_mass'],'.', color='g')
+
+    ax.grid(True)
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+
+    ax.set_title('The Largest 0.1 Halo')
+    ax.set_xlabel(r'$M_{0.2}$')
+    ax.set_ylabel(r'$M_{0.1}$')
+
+    return 'MaxMassComp.png'
+
+def NumberOccupancy(plt, fig, result):
+    H = result['H']
+    ax = fig.add_subplot(111)
+
+    ax.plot(np.arange(len(H)), H+1, color='r')
+    plt.title('The Number of 0.1 Halos in a 0.2 Halo')
+
+    ax.grid(True)
+    ax.set_yscale('log')
+    ax.set_xlabel('Number of Sub-Halos')
+    ax.set_ylabel('Frequency + 1')
+
+    return 'NumberOccupancy.png'
+
+def SubHaloPos(plt, fig, result):
+    (occupancy_l, occupancy_h), = result['occupancies']
+    (H , bin_edge), = result['densities']
+    ax = fig.add_subplot(111)
+
+    ax.plot(bin_edge[:-1], H , color='r')
+    DensityBand(ax, result, 0, bin_edge, 'r')
+    ax.grid(True)
+    ax.set_xlim(0,1)
+
+    plt.title('Positions of Sub-halos of occupancy '+ str(occupancy_l)+'-'+ str(occupancy_h)+ ' compared to the Main Halos centre')
+    ax.set_xlabel('Sub-Halo position from Main Halo centre divide by radius of Main Halo ')
+    ax.set_ylabel('Density')
+
+    return 'SubHaloPos_Occ='+str(occupancy_l)+'-'+str(occupancy_h)+'.png'
+
+def SubHaloPosComp(plt, fig, result):
+    ax = fig.add_subplot(111)
+
+    for k, ((occupancy_l, occupancy_h), (H, bin_edge)) in enumerate(zip(result['occupancies'], result['densities'])):
+        ax.plot(bin_edge[:-1], H , color=COLORS[k % len(COLORS)], label='occupancy '+str(occupancy_l)+'-'+str(occupancy_h))
+        DensityBand(ax, result, k, bin_edge, COLORS[k % len(COLORS)])
+    ax.grid(True)
+    ax.set_xlim(0,1)
+
+    plt.title('Positions of Sub-halos of different occupancy compared to the Main Halos centre')
+    ax.set_xlabel('Sub-Halo position from Main Halo centre divide by radius of Main Halo ')
+    ax.set_ylabel('Density')
+
+    handles, labels = ax.get_legend_handles_labels()
+    ax.legend(handles, labels)
+
+    return 'SubHaloPosComp.png'
+
+def SubHaloVel(plt, fig, result):
+    (occupancy_l, occupancy_h), = result['occupancies']
+    (H , bin_edge), = result['densities']
+    ax = fig.add_subplot(111)
+
+    ax.plot(bin_edge[:-1], H , color='r')
+    DensityBand(ax, result, 0, bin_edge, 'r')
+    ax.grid(True)
+
+    plt.title('Speed of Sub-halos of occupancy '+ str(occupancy_l)+'-'+ str(occupancy_h)+ ' compared to the Main Halos Speed')
+    ax.set_xlabel('Sub-Halo Speed subtract by speed of Main Halo ')
+    ax.set_ylabel('Density')
+
+    return 'SubHaloVel_Occ='+str(occupancy_l)+'-'+str(occupancy_h)+'.png'
+
+def SubHaloVelComp(plt, fig, result):
+    ax = fig.add_subplot(111)
+
+    for k, ((occupancy_l, occupancy_h), (H, bin_edge)) in enumerate(zip(result['occupancies'], result['densities'])):
+        ax.plot(bin_edge[:-1], H , color=COLORS[k % len(COLORS)], label='occupancy '+str(occupancy_l)+'-'+str(occupancy_h))
+        DensityBand(ax, result, k, bin_edge, COLORS[k % len(COLORS)])
+    ax.set_yscale('log')
+    ax.grid(True)
+
+    plt.title('Speed of Sub-halos of different occupancy compared to the Main Halos speed')
+    ax.set_xlabel('Sub-Halo speed subtract the  Main Halo speed ')
+    ax.set_ylabel('Density')
+
+    handles, labels = ax.get_legend_handles_labels()
+    ax.legend(handles, labels)
+
+    return 'SubHaloVelComp.png'
+
+def SubHaloPosVel(plt, fig, result):
+    occupancy_l, occupancy_h = result['occupancy']
+    ax = fig.add_subplot(111)
+
+    ax.scatter(result['RatioPos'], result['RatioVel'], color='r', marker='.')
+    ax.grid(True)
+
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+    ax.set_ylim(10**-4, 0.2*10**2)
+
+    ax.set_xlabel('Sub-halo position in Main halo')
+    ax.set_ylabel('Sub-halo relative speed')
+
+    return 'SubHaloPosVel_Occ='+str(occupancy_l)+'-'+str(occupancy_h)+'.png'
+
+def SubHaloPosVelDensity(plt, fig, result):
+    from matplotlib.colors import LogNorm
+    occupancy_l, occupancy_h = result['occupancy']
+    density = np.ma.masked_equal(result['density'], 0)
+    ax = fig.add_subplot(111)
+
+    mesh = ax.pcolormesh(result['pos_edges'], result['vel_edges'], density.T, norm=LogNorm(), cmap='viridis')
+    fig.colorbar(mesh, ax=ax, label='Density')
+
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+    ax.set_xlim(result['pos_edges'][0], result['pos_edges'][-1])
+    ax.set_ylim(result['vel_edges'][0], result['vel_edges'][-1])
+
+    ax.set_xlabel('Sub-halo position in Main halo')
+    ax.set_ylabel('Sub-halo relative speed')
+
+    return 'SubHaloPosVelDensity_Occ='+str(occupancy_l)+'-'+str(occupancy_h)+'.png'
+
+def TimeSeries(plt, fig, result):
+    series = result['series']
+    key = result['key']
+    use_redshift = len(series['redshift']) and not np.any(np.isnan(series['redshift']))
+    x = series['redshift'] if use_redshift else series['snapshot']
+    ax = fig.add_subplot(111)
+
+    ax.plot(x, series[key], '.-', color='r')
+    ax.grid(True)
+    if use_redshift:
+        ax.invert_xaxis()
+    ax.set_xlabel('Redshift' if use_redshift else 'Snapshot')
+    ax.set_ylabel(result['ylabel'])
+
+    return 'TimeSeries_'+key+'.png'
+
+RENDERERS = {'SumMassComp': SumMassComp, 'MaxMassComp': MaxMassComp,
+             'NumberOccupancy': NumberOccupancy,
+             'SubHaloPos': SubHaloPos, 'SubHaloPosComp': SubHaloPosComp,
+             'SubHaloVel': SubHaloVel, 'SubHaloVelComp': SubHaloVelComp,
+             'SubHaloPosVel': SubHaloPosVel, 'SubHaloPosVelDensity': SubHaloPosVelDensity,
+             'TimeSeries': TimeSeries}
+
+def Render(result, plot_dir=None):
+    # draws one result and returns the path of the saved figure
+    if plot_dir is None:
+        plot_dir = PLOT_DIR
+    plt = Pyplot()
+    fig = plt.figure()
+    try:
+        name = RENDERERS[result['figure']](plt, fig, result)
+        os.makedirs(plot_dir, exist_ok=True)
+        path = os.path.join(plot_dir, name)
+        fig.savefig(path, dpi=fig.dpi)
+    finally:
+        plt.close(fig)
+    return path
+
+def RenderTask(args):
+    result, plot_dir = args
+    return Render(result, plot_dir)
+
+def RenderAll(results, plot_dir=None, nproc=1):
+    # results without a 'figure' key (e.g. MR.MassRelation) are skipped
+    results = [result for result in results if isinstance(result, dict) and 'figure' in result]
+    tasks = [(result, plot_dir) for result in results]
+    if nproc > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(nproc, len(tasks))) as pool:
+            return pool.map(RenderTask, tasks)
+    return [RenderTask(task) for task in tasks]
@@ -0,0 +1,199 @@
+import queue
+import threading
+import numpy as np
+import h5py
+import Instrument as IN
+
+# Streaming access to a halos_XXX.hdf5 catalogue.
+#
+# The file is opened with the default (on-disk) driver and host halos are
+# visited in batches whose particle data fits in a memory budget, so peak
+# memory does not grow with the size of the catalogue.  Each batch is a dict:
+#   first, last              host index range [first, last)
+#   halo_nPart, nHaloSub     per host
+#   part_offset              host k owns Halo_Pos/Halo_Vel rows part_offset[k]:part_offset[k+1]
+#   Halo_Pos, Halo_Vel       stacked particles of the batch
+#   mean_vel                 per host
+#   sub_offset               host k owns subhalo rows sub_offset[k]:sub_offset[k+1]
+#   subhalo_nPart, subhalo_mean_pos, subhalo_mean_vel
+#
+# When a fresh repacked particle store (see ParticleStore) sits next to
+# the catalogue the batches are bulk slices of it; IterRawBatches always
+# reads the per-host groups.
+#
+# IterHostBatches reads ahead on a background thread: up to `prefetch`
+# batches wait in a bounded queue while the current one is processed, so
+# reads overlap the numpy work (which releases the GIL).  Up to prefetch+2
+# batches are then held at once (the queue, the one being processed and
+# the one the reader is waiting to queue), so the memory budget is split
+# between them and peak memory stays within it; the time the consumer
+# spends waiting for data is reported as the 'wait' phase.  prefetch=0
+# reads inline.
+
+DEFAULT_MEMORY_BUDGET = 256*2**20
+
+# Bytes per byte of particle data read: the float32 positions and
+# velocities (24 B per particle) plus the temporaries of
+# HK.SegmentedHostReduce (about 24 B per particle) and of the summary
+# columns built from them, with headroom.
+KERNEL_OVERHEAD = 4
+
+DEFAULT_PREFETCH = 2
+
+def OpenSnapshot(halo_snapshot):
+    # small raw-data chunk cache: batches are read once, in order
+    return h5py.File(halo_snapshot, 'r', rdcc_nbytes=4*2**20)
+
+def CountGroups(g):
+    # number of child groups, from link metadata only (no objects are opened)
+    return sum(1 for name in g if g.get(name, getclass=True) is h5py.Group)
+
+def CountHosts(f):
+    return CountGroups(f)
+
+def HostBytes(halo):
+    # particles are held as float32 once read
+    return (halo['Halo_Pos'].size + halo['Halo_Vel'].size)*4*KERNEL_OVERHEAD
+
+def PlanBatches(f, first=0, last=None, memory_budget=None, batch_size=None):
+    # host index ranges [a, b) whose particle data fits the budget;
+    # only dataset shapes are looked at, no particle data is read
+    if memory_budget is None:
+        memory_budget = DEFAULT_MEMORY_BUDGET
+    if last is None:
+        last = CountHosts(f)
+    batches = []
+    a = first
+    nbytes = 0
+    for i in range(first, last):
+        host_bytes = HostBytes(f['/'+str(i)])
+        IN.Count('hdf5_objects', 3)
+        full = i > a and (nbytes + host_bytes > memory_budget or
+                          (batch_size is not None and i - a >= batch_size))
+        if full:
+            batches.append((a, i))
+            a = i
+            nbytes = 0
+        nbytes += host_bytes
+    if last > a:
+        batches.append((a, last))
+    return batches
+
+def ReadBatch(f, a, b):
+    hosts = [f['/'+str(i)] for i in range(a, b)]
+    nHost = b - a
+    halo_nPart = np.empty(nHost, dtype=np.int32)
+    nHaloSub = np.empty(nHost, dtype=np.int32)
+    part_offset = np.zeros(nHost+1, dtype=np.int64)
+    for k, halo in enumerate(hosts):
+        halo_nPart[k] = halo.attrs['halo_nPart']
+        nHaloSub[k] = CountGroups(halo)
+        part_offset[k+1] = part_offset[k] + halo['Halo_Pos'].shape[0]
+    sub_offset = np.zeros(nHost+1, dtype=np.int64)
+    np.cumsum(nHaloSub, out=sub_offset[1:])
+
+    nPart = int(part_offset[-1])
+    nSub = int(sub_offset[-1])
+    Halo_Pos = np.empty((nPart, 3), dtype=np.float32)
+    Halo_Vel = np.empty((nPart, 3), dtype=np.float32)
+    mean_vel = np.empty((nHost, 3), dtype=np.float32)
+    subhalo_nPart = np.empty(nSub, dtype=np.int32)
+    subhalo_mean_pos = np.empty((nSub, 3), dtype=np.float32)
+    subhalo_mean_vel = np.empty((nSub, 3), dtype=np.float32)
+
+    for k, halo in enumerate(hosts):
+        p0, p1 = part_offset[k], part_offset[k+1]
+        if p1 > p0:
+            halo['Halo_Pos'].read_direct(Halo_Pos, dest_sel=np.s_[p0:p1])
+            halo['Halo_Vel'].read_direct(Halo_Vel, dest_sel=np.s_[p0:p1])
+        mean_vel[k] = halo['mean_vel'][()]
+        s0 = sub_offset[k]
+        for j in range(0, nHaloSub[k]):
+            sub = halo[str(j)]
+            subhalo_nPart[s0+j] = sub.attrs['subhalo_nPart']
+            subhalo_mean_pos[s0+j] = sub['subhalo_mean_pos'][()]
+            subhalo_mean_vel[s0+j] = sub['subhalo_mean_vel'][()]
+
+    IN.Count('hdf5_objects', 4*nHost + 3*nSub)
+    IN.Count('bytes_read', Halo_Pos.nbytes + Halo_Vel.nbytes + mean_vel.nbytes +
+             subhalo_mean_pos.nbytes + subhalo_mean_vel.nbytes)
+
+    return {'first': a, 'last': b,
+            'halo_nPart': halo_nPart, 'nHaloSub': nHaloSub,
+            'part_offset': part_offset, 'Halo_Pos': Halo_Pos, 'Halo_Vel': Halo_Vel,
+            'mean_vel': mean_vel, 'sub_offset': sub_offset,
+            'subhalo_nPart': subhalo_nPart,
+            'subhalo_mean_pos': subhalo_mean_pos, 'subhalo_mean_vel': subhalo_mean_vel}
+
+def IterRawBatches(halo_snapshot, memory_budget=None, batch_size=None, first=0, last=None):
+    with OpenSnapshot(halo_snapshot) as f:
+        with IN.Phase('plan'):
+            batches = PlanBatches(f, first, last, memory_budget, batch_size)
+        for a, b in batches:
+            with IN.Phase('read'):
+                batch = ReadBatch(f, a, b)
+            yield batch
+
+def Prefetch(items, depth=None):
+    # iterate over items, producing them on a background thread
+    if depth is None:
+        depth = DEFAULT_PREFETCH
+    if depth <= 0:
+        yield from items
+        return
+    ready = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def Put(entry):
+        while not stop.is_set():
+            try:
+                ready.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def Produce():
+        try:
+            for item in items:
+                if not Put((True, item)):
+                    return
+            Put((False, None))
+        except BaseException as exc:
+            Put((False, exc))
+        finally:
+            # the consumer may stop early: release the source (open files) here
+            if hasattr(items, 'close'):
+                items.close()
+
+    worker = threading.Thread(target=Produce, daemon=True)
+    worker.start()
+    try:
+        while True:
+            with IN.Phase('wait'):
+                more, item = ready.get()
+            if not more:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+        worker.join()
+
+def LiveBatches(prefetch):
+    # batches held at once when reading ahead `prefetch` batches
+    return prefetch + 2 if prefetch > 0 else 1
+
+def IterHostBatches(halo_snapshot, memory_budget=None, batch_size=None, first=0, last=None, prefetch=None):
+    import ParticleStore as PS
+    if prefetch is None:
+        prefetch = DEFAULT_PREFETCH
+    if memory_budget is None:
+        memory_budget = DEFAULT_MEMORY_BUDGET
+    memory_budget //= LiveBatches(prefetch)
+    if PS.IsFresh(halo_snapshot):
+        batches = PS.IterStoreBatches(PS.StorePath(halo_snapshot), memory_budget, batch_size, first, last)
+    else:
+        batches = IterRawBatches(halo_snapshot, memory_budget, batch_size, first, last)
+    return Prefetch(batches, prefetch)
@@ -0,0 +1,159 @@
+import os
+import multiprocessing
+import numpy as np
+import h5py
+import HaloKernels as HK
+import HaloStream as HSt
+import Instrument as IN
+
+# Columnar sidecar of a halos_XXX.hdf5 catalogue.
+#
+# Host arrays (length nHalo):
+#   halo_nPart, nHaloSub, Halo_Pos (max particle radius), Halo_Vel (mean
+#   particle speed), Sigma (trace of the velocity dispersion tensor),
+#   Sigma_tensor (the full 3x3 dispersion tensor)
+# The summary does not know the box size; periodic host centres and
+# host-centric radii come from SpatialIndex.HostGeometry.
+# Flat subhalo table (length nSub), host i owns rows sub_offset[i]:sub_offset[i+1]:
+#   subhalo_nPart, subhalo_mean_pos, subhalo_mean_vel
+
+SUMMARY_VERSION = 2
+
+HOST_COLUMNS = ['halo_nPart', 'nHaloSub', 'Halo_Pos', 'Halo_Vel', 'Sigma', 'Sigma_tensor']
+SUB_COLUMNS = ['subhalo_nPart', 'subhalo_mean_pos', 'subhalo_mean_vel']
+
+def SummaryPath(halo_snapshot):
+    root, ext = os.path.splitext(halo_snapshot)
+    return root + '_summary' + ext
+
+def TempPath(path):
+    # sidecars are written under this name and renamed once complete, so an
+    # interrupted write never looks fresh
+    return path + '.tmp'
+
+def SourceStamp(halo_snapshot):
+    st = os.stat(halo_snapshot)
+    return {'source_size': st.st_size, 'source_mtime': st.st_mtime}
+
+def IsFresh(halo_snapshot, summary_file):
+    if not os.path.exists(summary_file):
+        return False
+    stamp = SourceStamp(halo_snapshot)
+    with h5py.File(summary_file, 'r') as s:
+        if s.attrs.get('summary_version', -1) != SUMMARY_VERSION or 'sub_offset' not in s:
+            return False
+        for key, value in stamp.items():
+            if s.attrs.get(key) != value:
+                return False
+    return True
+
+def SummarizeBatch(batch):
+    # host/subhalo summary columns of one HaloStream batch
+    Halo_Pos, Halo_Vel, Sigma_tensor = HK.SegmentedHostReduce(
+        batch['Halo_Pos'], batch['Halo_Vel'], batch['part_offset'], batch['mean_vel'])
+    return {'halo_nPart': batch['halo_nPart'], 'nHaloSub': batch['nHaloSub'],
+            'Halo_Pos': Halo_Pos, 'Halo_Vel': Halo_Vel,
+            'Sigma': HK.Dispersion(Sigma_tensor), 'Sigma_tensor': Sigma_tensor,
+            'subhalo_nPart': batch['subhalo_nPart'],
+            'subhalo_mean_pos': batch['subhalo_mean_pos'],
+            'subhalo_mean_vel': batch['subhalo_mean_vel']}
+
+def CreateSummary(s, halo_snapshot):
+    s.attrs['summary_version'] = SUMMARY_VERSION
+    s.attrs['source'] = os.path.abspath(halo_snapshot)
+    for key, value in SourceStamp(halo_snapshot).items():
+        s.attrs[key] = value
+    s.create_dataset('halo_nPart', (0,), maxshape=(None,), dtype=np.int32)
+    s.create_dataset('nHaloSub', (0,), maxshape=(None,), dtype=np.int32)
+    s.create_dataset('Halo_Pos', (0,), maxshape=(None,), dtype=np.float32)
+    s.create_dataset('Halo_Vel', (0,), maxshape=(None,), dtype=np.float32)
+    s.create_dataset('Sigma', (0,), maxshape=(None,), dtype=np.float32)
+    s.create_dataset('Sigma_tensor', (0, 3, 3), maxshape=(None, 3, 3), dtype=np.float32)
+    s.create_dataset('subhalo_nPart', (0,), maxshape=(None,), dtype=np.int32)
+    s.create_dataset('subhalo_mean_pos', (0, 3), maxshape=(None, 3), dtype=np.float32)
+    s.create_dataset('subhalo_mean_vel', (0, 3), maxshape=(None, 3), dtype=np.float32)
+
+def AppendSummary(s, columns):
+    for key in HOST_COLUMNS + SUB_COLUMNS:
+        ds = s[key]
+        n = ds.shape[0]
+        ds.resize(n + len(columns[key]), axis=0)
+        ds[n:] = columns[key]
+
+def FinishSummary(s):
+    nHaloSub = s['nHaloSub'][()]
+    sub_offset = np.zeros(len(nHaloSub)+1, dtype=np.int64)
+    np.cumsum(nHaloSub, out=sub_offset[1:])
+    s['sub_offset'] = sub_offset
+    print('nHalo:', len(nHaloSub))
+    print('nSub:', int(sub_offset[-1]))
+
+def MergeSummaries(partials):
+    # partials cover consecutive host ranges, so merging is concatenation
+    merged = {}
+    for key in HOST_COLUMNS + SUB_COLUMNS:
+        merged[key] = np.concatenate([p[key] for p in partials])
+    return merged
+
+def SummarizeRange(args):
+    # worker: open the snapshot read-only and summarise hosts [first, last)
+    halo_snapshot, first, last, memory_budget, batch_size = args
+    partials = [SummarizeBatch(batch) for batch in
+                HSt.IterHostBatches(halo_snapshot, memory_budget, batch_size, first, last)]
+    return MergeSummaries(partials)
+
+def SplitHosts(nHalo, nChunk):
+    edges = np.linspace(0, nHalo, nChunk+1).astype(np.int64)
+    return [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+def ExtractSummary(halo_snapshot, summary_file=None, memory_budget=None, batch_size=None, nproc=1):
+    if summary_file is None:
+        summary_file = SummaryPath(halo_snapshot)
+
+    with h5py.File(TempPath(summary_file), 'w') as s:
+        CreateSummary(s, halo_snapshot)
+        with HSt.OpenSnapshot(halo_snapshot) as f:
+            nHalo = HSt.CountHosts(f)
+        progress = IN.Progress('summary', nHalo)
+        if nproc > 1:
+            # several ranges per worker so uneven hosts still balance;
+            # imap keeps range order, so the result matches the serial run
+            ranges = SplitHosts(nHalo, 4*nproc)
+            if memory_budget is None:
+                memory_budget = HSt.DEFAULT_MEMORY_BUDGET
+            tasks = [(halo_snapshot, a, b, memory_budget//nproc, batch_size) for a, b in ranges]
+            with multiprocessing.Pool(nproc) as pool:
+                for (a, b), partial in zip(ranges, pool.imap(SummarizeRange, tasks)):
+                    with IN.Phase('write'):
+                        AppendSummary(s, partial)
+                    progress.Update(b)
+        else:
+            for batch in HSt.IterHostBatches(halo_snapshot, memory_budget, batch_size):
+                with IN.Phase('reduce'):
+                    columns = SummarizeBatch(batch)
+                with IN.Phase('write'):
+                    AppendSummary(s, columns)
+                progress.Update(batch['last'])
+        FinishSummary(s)
+    os.replace(TempPath(summary_file), summary_file)
+
+    return summary_file
+
+def LoadSummary(halo_snapshot, columns=None, summary_file=None, memory_budget=None, nproc=1):
+    if summary_file is None:
+        summary_file = SummaryPath(halo_snapshot)
+    if not IsFresh(halo_snapshot, summary_file):
+        ExtractSummary(halo_snapshot, summary_file, memory_budget, nproc=nproc)
+    if columns is None:
+        columns = HOST_COLUMNS + SUB_COLUMNS
+    summary = {}
+    with h5py.File(summary_file, 'r') as s:
+        summary['sub_offset'] = s['sub_offset'][()]
+        for key in columns:
+            summary[key] = s[key][()]
+    return summary
+
+def SubHost(summary):
+    # host index of every row in the flat subhalo table
+    nHaloSub = np.diff(summary['sub_offset'])
+    return np.repeat(np.arange(len(nHaloSub)), nHaloSub)
@@ -0,0 +1,97 @@
+import sys
+import json
+import time
+import threading
+import resource
+import cProfile
+import contextlib
+
+# Phase timing and I/O counters for the catalogue scans.
+#
+#   with IN.Phase('read'):
+#       ...
+#   IN.Count('hdf5_objects', 3)
+#   IN.Count('bytes_read', arr.nbytes)
+#   IN.WriteReport('report.json')
+#
+# Phases accumulate wall time and call counts under their name; counters
+# are plain sums.  The report also carries the peak resident memory of the
+# process.  Progress prints at most once every PROGRESS_INTERVAL seconds.
+# Phases and counters may be updated from the HaloStream prefetch thread.
+
+PROGRESS_INTERVAL = 10.0
+
+_phases = {}
+_counters = {}
+_lock = threading.Lock()
+
+def Reset():
+    _phases.clear()
+    _counters.clear()
+
+@contextlib.contextmanager
+def Phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            phase = _phases.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            phase['seconds'] += elapsed
+            phase['calls'] += 1
+
+def Count(name, n=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + int(n)
+
+def PeakMemory():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak*1024
+
+def Report():
+    with _lock:
+        return {'phases': {name: dict(phase) for name, phase in _phases.items()},
+                'counters': dict(_counters),
+                'peak_rss_bytes': PeakMemory()}
+
+def WriteReport(path):
+    with open(path, 'w') as out:
+        json.dump(Report(), out, indent=1)
+    return path
+
+@contextlib.contextmanager
+def Profile(path=None):
+    # cProfile dump of the enclosed block, loadable with pstats / snakeviz
+    if path is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+
+class Progress:
+    def __init__(self, label, total, interval=None):
+        self.label = label
+        self.total = total
+        self.interval = PROGRESS_INTERVAL if interval is None else interval
+        self.start = time.perf_counter()
+        self.last = self.start
+
+    def Update(self, done):
+        now = time.perf_counter()
+        if now - self.last < self.interval and done < self.total:
+            return
+        self.last = now
+        elapsed = now - self.start
+        percent = 100*done/self.total if self.total else 100
+        eta = elapsed*(self.total - done)/done if done else float('nan')
+        print('Progress {}: {}/{} ({:.0f}%) {:.1f}s elapsed, {:.1f}s left'.format(
+            self.label, done, self.total, percent, elapsed, eta))
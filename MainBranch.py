@@ -0,0 +1,124 @@
+import os
+import numpy as np
+
+# Main branches of every halo in a TreeStore, from array operations.
+#
+# Halos of all snapshots get a global index: snapshot k's rows start at
+# snap_base[k].  main_prog[g] is the global index of the most massive
+# progenitor of halo g in the previous snapshot (-1 if it has none); it is
+# computed once per store and saved with it as derived/main_prog.npy.
+#
+# From that pointer array the main branch of every z=0 root is followed
+# one snapshot at a time for all roots together, giving branch lengths and
+# mass histories.  Growth and fluctuation use the usual merger-tree
+# definitions between consecutive snapshots k, k+1:
+#   alpha = (t_k+1 + t_k)(M_k+1 - M_k) / ((t_k+1 - t_k)(M_k+1 + M_k))
+#   beta  = 2/pi arctan(alpha)                (log-mass growth)
+#   xi    = (beta_k,k+1 - beta_k-1,k)/2       (mass fluctuation)
+# The particle `cutoff` is applied as a mask: roots below it are dropped
+# and growth steps involving a halo below it are NaN.  Growth needs the
+# cosmic time of every snapshot of the branches (see TreeStore); without
+# it LogMassGrowth raises instead of using another clock.
+
+def SnapBase(store):
+    counts = [len(store.HaloIDs(snap)) for snap in store.snapshots]
+    snap_base = np.zeros(len(counts)+1, dtype=np.int64)
+    np.cumsum(counts, out=snap_base[1:])
+    return snap_base
+
+def SegmentArgMax(values, offset):
+    # index (into values) of the first maximum of every segment, -1 for empty ones
+    counts = np.diff(offset)
+    seg = np.repeat(np.arange(len(counts)), counts)
+    order = np.lexsort((-np.arange(len(values)), values, seg))
+    result = np.full(len(counts), -1, dtype=np.int64)
+    full = counts > 0
+    result[full] = order[offset[1:][full] - 1]
+    return result
+
+def MainProgenitors(store, snap_base):
+    main_prog = np.full(snap_base[-1], -1, dtype=np.int64)
+    for k in range(1, len(store.snapshots)):
+        snap = store.snapshots[k]
+        prev = store.snapshots[k-1]
+        offset, ids = store.Edges(snap, 'prog')
+        offset = np.asarray(offset)
+        rows = store.Rows(prev, np.asarray(ids))
+        # progenitors missing from the previous snapshot never win
+        mass = np.where(rows >= 0, np.asarray(store.nPart(prev))[np.maximum(rows, 0)], -1)
+        best = SegmentArgMax(mass, offset)
+        has = best >= 0
+        has[has] = mass[best[has]] >= 0
+        main_prog[snap_base[k]:snap_base[k+1]][has] = snap_base[k-1] + rows[best[has]]
+    return main_prog
+
+def LoadMainProgenitors(store):
+    path = store.DerivedPath('main_prog.npy')
+    snap_base = SnapBase(store)
+    if os.path.exists(path):
+        main_prog = np.load(path, mmap_mode='r')
+        if len(main_prog) == snap_base[-1]:
+            return snap_base, main_prog
+    main_prog = MainProgenitors(store, snap_base)
+    store.SaveDerived('main_prog.npy', main_prog)
+    return snap_base, main_prog
+
+def GlobalnPart(store):
+    return np.concatenate([np.asarray(store.nPart(snap)) for snap in store.snapshots])
+
+def Times(store):
+    # NaN for snapshots the store has no time for
+    return np.asarray(store.times, dtype=np.float64)
+
+def MainBranches(store, root_snap=None, cutoff=None):
+    if root_snap is None:
+        root_snap = store.snapshots[-1]
+    snap_base, main_prog = LoadMainProgenitors(store)
+    nPart = GlobalnPart(store)
+    k_root = store.SnapIndex(root_snap)
+
+    roots = np.arange(snap_base[k_root], snap_base[k_root+1])
+    if cutoff is not None:
+        roots = roots[nPart[roots] >= cutoff]
+
+    nSnap = k_root + 1
+    mass = np.full((len(roots), nSnap), np.nan)
+    length = np.zeros(len(roots), dtype=np.int64)
+    current = roots.copy()
+    for k in range(k_root, -1, -1):
+        alive = current >= 0
+        mass[alive, k] = nPart[current[alive]]
+        length += alive
+        current[alive] = main_prog[current[alive]]
+
+    return {'root_snap': root_snap,
+            'root_ids': np.asarray(store.HaloIDs(root_snap))[roots - snap_base[k_root]],
+            'length': length, 'mass': mass, 'times': Times(store)[:nSnap],
+            'snapshots': store.snapshots[:nSnap], 'cutoff': cutoff}
+
+def LogMassGrowth(branches):
+    mass = branches['mass']
+    t = branches['times']
+    if np.any(np.isnan(t)):
+        missing = [snap for snap, time in zip(branches['snapshots'], t) if np.isnan(time)]
+        raise ValueError('no time for snapshots {}: rewrite the TreeStore with snap_data'.format(missing))
+    M0, M1 = mass[:, :-1], mass[:, 1:]
+    t0, t1 = t[:-1], t[1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alpha = (t1 + t0)*(M1 - M0)/((t1 - t0)*(M1 + M0))
+    beta = 2/np.pi*np.arctan(alpha)
+    if branches['cutoff'] is not None:
+        beta[(M0 < branches['cutoff']) | (M1 < branches['cutoff'])] = np.nan
+    return beta
+
+def MassFluctuation(branches, beta=None):
+    if beta is None:
+        beta = LogMassGrowth(branches)
+    return (beta[:, 1:] - beta[:, :-1])/2
+
+def MainBranchStats(store, root_snap=None, cutoff=None):
+    # branch lengths, log-mass growth and mass fluctuations of every root
+    branches = MainBranches(store, root_snap, cutoff)
+    branches['beta'] = LogMassGrowth(branches)
+    branches['xi'] = MassFluctuation(branches, branches['beta'])
+    return branches
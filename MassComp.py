@@ -1,19 +1,24 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import h5py
+import HaloEngine as HE
+import OccupancyIndex as OI
+import MassRelation as MR
+import TreeStore as TS
+import HaloMatch as HM
                     
-def test(tree_data_1, tree_data_2, snap_data):
-    z0_halos_1 = list(tree_data_1['061'].keys())
-    z0_halos_2 = list(tree_data_2['061'].keys())
+def HaloIDs(tree_data, snap='061'):
+    # sorted integer halo IDs of a snapshot, from a TreeStore or a pickled tree dict
+    if isinstance(tree_data, TS.TreeStore):
+        return np.asarray(tree_data.HaloIDs(snap))
+    return np.sort(np.array([int(x) for x in tree_data[snap].keys()], dtype=np.int64))
 
-    z0_halos_1 = [int(x) for x in z0_halos_1]
-    z0_halos_2 = [int(x) for x in z0_halos_2]
-     
-    z0_halos_1.sort()
-    z0_halos_2.sort()
+def test(tree_data_1, tree_data_2, snap_data):
+    z0_halos_1 = HaloIDs(tree_data_1)
+    z0_halos_2 = HaloIDs(tree_data_2)
 
     print('z0_halos_1:', z0_halos_1)
     print('z0_halos_2:', z0_halos_2)
+    print('z0 IDs in both:', np.sum(HM.JoinIDs(z0_halos_1, z0_halos_2) >= 0))
 
     return
 
@@ -27,207 +32,96 @@ def h5py_dataset_iterator(g, prefix=''):
             yield from h5py_dataset_iterator(item, path)
     return
 
-def SumMassCompPlot(halo_snapshot):
-    f=h5py.File(halo_snapshot, 'r', driver='core')
-    #print('f.keys():',list(f.keys()))
-    datasets = [item for item in f.values() if isinstance(item, h5py.Dataset)]
-    groups = [item for item in f.values() if isinstance(item, h5py.Group)]
-    print('len(groups):',len(groups))
-    print('len(datasets):',len(datasets))
-    base_list=len(f['/Halo_IDs/'])
-    nHalo = len(groups)
-    print('nHalo:',nHalo)
-    main_mass = np.empty(nHalo,dtype=np.int32)
-    nHaloSub=np.empty(nHalo,dtype=np.int32)
-    progress = -1
-    
-    # First loop to count halos
-    iSub=0
-    nSub=0
-    for i in range(0,nHalo):
-        previous_progress = progress
-        progress = int(i/nHalo * 100)
-        if progress != previous_progress:
-            print('Progress main_IDs: ', progress, '%')
-        main_mass[i]=f['/'+str(i)].attrs['halo_nPart']
-        nHaloSub[i] = len([item for item in f['/'+str(i)].values() if isinstance(item, h5py.Group)])
-    nSub=np.sum(nHaloSub)
-
-
-    # Array to hold subhalo masses
-    sub_mass=np.empty(nSub,dtype=np.int32)
-    split_sub_mass = np.empty(nSub,dtype=np.int32)
-    tot_sub_mass=np.empty(nHalo,dtype=np.int32)
-    iSub=0
-    
-    progress = -1
-    for i in range(0, nHalo):
-        previous_progress = progress
-        progress = int(i/nHalo * 100)
-        if progress != previous_progress:
-            print('Progress sub_IDs: ', progress, '%')
-        for j in range(0,nHaloSub[i]):
-            sub_mass[iSub]=f['/'+str(i)+'/'+str(j)].attrs['subhalo_nPart']
-            #print('len(sub_mass):',len(sub_mass))
-            #print('sub_mass:',sub_mass)
-            iSub +=1
-
-    print('nhaloSub:',nHaloSub)
-    print('len(nHaloSub):',len(nHaloSub))
-    split_sub_mass = np.split(sub_mass, np.cumsum(nHaloSub)[:-1])
-    tot_sub_mass = [sum(x) for x in split_sub_mass]
-    #print('sub_mass:',sub_mass)
-    #print('len(nHaloSub):',len(main_mass))
-    #print('main_mass:',main_mass)
-    print('len(main_mass):',len(main_mass))
-    print('main_mass:',main_mass)
-    print('len(sub_mass):',len(sub_mass))
-    print('sub_mass:',sub_mass)
-    print('len(split_sub_mass):',len(split_sub_mass))
-    #print('split_sub_mass:',split_sub_mass)
-    #print('tot_sub_mass:',list(tot_sub_mass))
-    print('len(tot_sub_mass):',len(tot_sub_mass))
-
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
- 
-    ax.plot(main_mass, tot_sub_mass,'.', color='r')
-
-    ax.grid(True)
-    ax.set_xscale('log')
-    ax.set_yscale('log')
-
-    ax.set_title('The Sum of 0.1 Linking Lengths')
-    ax.set_xlabel(r'$M_{0.2}$')
-    ax.set_ylabel(r'$M_{0.1}$')
-
-    plt.savefig('Plots/SumMassComp.png', dpi=fig.dpi)
-
-    plt.clf()
-    
-    return
+def MassBand(main_mass, sub_mass, bands, bins=20):
+    # (edges, counts, stats) of sub_mass per host-mass bin when bands are asked for
+    if not bands:
+        return None
+    return MR.BinnedStats(main_mass, sub_mass, bins)
 
-def NumOcup(halo_snapshot):
-    f=h5py.File(halo_snapshot, 'r', driver='core')
-    #print('f.keys():',list(f.keys()))
-    groups = [item for item in f.values() if isinstance(item, h5py.Group)]
-    print('len(groups):',len(groups))
-    nHalo = len(groups)
-    nsub = np.empty(nHalo,dtype=np.int32)
-    print('nHalo:',nHalo)
-    progress = -1
-    
-    for i in range(0, nHalo):
-        previous_progress = progress
-        progress = int(i/nHalo * 100)
-        if progress != previous_progress:
-            print('Progress sub_IDs: ', progress, '%')
-        nsub[i] = len([item for item in f[str(i)].values() if isinstance(item, h5py.Group)])
-
-    print('nsub:',nsub)
-    print('len(nsub):',len(nsub))
+def Concatenate(parts):
+    # per-chunk arrays joined; no chunks (no hosts) gives an empty array
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
 
-    bins = np.amax(nsub)
+class SumMassCompAcc:
+    columns = ['halo_nPart', 'subhalo_nPart']
 
-    H, bin_edge = np.histogram(nsub, bins)
+    def __init__(self, bands=False):
+        self.bands = bands
+        self.main_mass = []
+        self.tot_sub_mass = []
 
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
+    def Update(self, chunk):
+        self.main_mass.append(chunk['halo_nPart'])
+        self.tot_sub_mass.append(MR.SegmentSum(chunk['subhalo_nPart'], chunk['sub_offset']))
 
-    ax.plot(bin_edge[:-1], H+1, color='r')
-    plt.title('The Number of 0.1 Halos in a 0.2 Halo')
+    def Finish(self):
+        main_mass = Concatenate(self.main_mass)
+        tot_sub_mass = Concatenate(self.tot_sub_mass)
+        print('len(main_mass):',len(main_mass))
+        print('main_mass:',main_mass)
+        print('len(tot_sub_mass):',len(tot_sub_mass))
 
-    ax.grid(True)
-    ax.set_yscale('log')
-    ax.set_xlabel('Number of Sub-Halos')
-    ax.set_ylabel('Frequency + 1')
+        return {'figure': 'SumMassComp', 'main_mass': main_mass, 'tot_sub_mass': tot_sub_mass,
+                'band': MassBand(main_mass, tot_sub_mass, self.bands)}
 
-    plt.savefig('Plots/NumberOccupancy.png', dpi=fig.dpi)
+def SumMassCompPlot(halo_snapshot, bands=False, nproc=1):
+    return HE.Traverse(halo_snapshot, [SumMassCompAcc(bands)], nproc=nproc)[0]
 
-    plt.close()
+def NumOcupResult(H):
+    return {'figure': 'NumberOccupancy', 'H': H}
 
-    return
+class NumOcupAcc:
+    columns = ['nHaloSub']
 
-def MaxMassCompPlot(halo_snapshot):
-    f=h5py.File(halo_snapshot, 'r', driver='core')
-    #print('f.keys():',list(f.keys()))
-    datasets = [item for item in f.values() if isinstance(item, h5py.Dataset)]
-    groups = [item for item in f.values() if isinstance(item, h5py.Group)]
-    print('len(groups):',len(groups))
-    print('len(datasets):',len(datasets))
-    base_list=len(f['/Halo_IDs/'])
-    nHalo = len(groups)
-    print('nHalo:',nHalo)
-    main_mass = np.empty(nHalo,dtype=np.int32)
-    nHaloSub=np.empty(nHalo,dtype=np.int32)
-    progress = -1
-
-    # First loop to count halos
-    iSub=0
-    nSub=0
-    for i in range(0,nHalo):
-        previous_progress = progress
-        progress = int(i/nHalo * 100)
-        if progress != previous_progress:
-            print('Progress main_IDs: ', progress, '%')
-        main_mass[i]=f['/'+str(i)].attrs['halo_nPart']
-        nHaloSub[i] = len([item for item in f['/'+str(i)].values() if isinstance(item, h5py.Group)])
-    nSub=np.sum(nHaloSub)
-
-    # Array to hold subhalo masses
-    sub_mass=np.empty(nSub,dtype=np.int32)
-    split_sub_mass = np.empty(nHalo,dtype=np.int32)
-    tot_sub_mass=np.empty(nHalo,dtype=np.int32)
-    iSub=0
-    
-    progress = -1
-    for i in range(0, nHalo):
-        previous_progress = progress
-        progress = int(i/nHalo * 100)
-        if progress != previous_progress:
-            print('Progress sub_IDs: ', progress, '%')
-        for j in range(0,nHaloSub[i]):
-            sub_mass[iSub]=f['/'+str(i)+'/'+str(j)].attrs['subhalo_nPart']
-            #print('len(sub_mass):',len(sub_mass))
-            #print('sub_mass:',sub_mass)
-            iSub +=1
-
-    print('nHaloSub:',nHaloSub)
-    print('len(nHaloSub):',len(nHaloSub))
-    split_sub_mass = np.split(sub_mass, np.cumsum(nHaloSub)[:-1])
-    print('len(split_sub_mass):',len(split_sub_mass))
-    #print('split_sub_mass:',split_sub_mass)
-    max_sub_mass = [max(x, default=0) for x in split_sub_mass]
-    Main_mass = [x if x in main_mass else 0 for x in max_sub_mass]
-    #print('sub_mass:',sub_mass)
-    #print('len(nHaloSub):',len(main_mass))
-    #print('main_mass:',main_mass)
-    print('len(main_mass):',len(main_mass))
-    print('main_mass:',main_mass)
-    print('len(sub_mass):',len(sub_mass))
-    print('sub_mass:',sub_mass)
-    #print('split_sub_mass:',split_sub_mass)
-    #print('max_sub_mass:',(max_sub_mass))
-    print('len(max_sub_mass):',len((max_sub_mass)))
-
-    mass_largest = [x for x in max_sub_mass if x >=10000]
-    print('mass_largest:', mass_largest)
-
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
- 
-    ax.plot(main_mass, max_sub_mass,'.', color='g')
-
-    ax.grid(True)
-    ax.set_xscale('log')
-    ax.set_yscale('log')
-
-    ax.set_title('The Largest 0.1 Halo')
-    ax.set_xlabel(r'$M_{0.2}$')
-    ax.set_ylabel(r'$M_{0.1}$')
-
-    plt.savefig('Plots/MaxMassComp.png', dpi=fig.dpi)
-
-    plt.clf()
-    
-    return
+    def __init__(self):
+        self.H = np.zeros(1, dtype=np.int64)
+
+    def Update(self, chunk):
+        H = OI.OccupancyCounts(chunk['nHaloSub'])
+        if len(H) > len(self.H):
+            H[:len(self.H)] += self.H
+            self.H = H
+        else:
+            self.H[:len(H)] += H
+
+    def Finish(self):
+        print('H:',self.H)
+
+        return NumOcupResult(self.H)
+
+def NumOcup(halo_snapshot, nproc=1):
+    # histogram of the occupancy index, no traversal of the catalogue
+    nsub, sub_offset = OI.LoadIndex(halo_snapshot, nproc=nproc)
+    print('len(nsub):',len(nsub))
+    H = OI.OccupancyCounts(nsub)
+    print('H:',H)
+
+    return NumOcupResult(H)
+
+class MaxMassCompAcc:
+    columns = ['halo_nPart', 'subhalo_nPart']
+
+    def __init__(self, bands=False):
+        self.bands = bands
+        self.main_mass = []
+        self.max_sub_mass = []
+
+    def Update(self, chunk):
+        self.main_mass.append(chunk['halo_nPart'])
+        self.max_sub_mass.append(MR.SegmentMax(chunk['subhalo_nPart'], chunk['sub_offset']))
+
+    def Finish(self):
+        main_mass = Concatenate(self.main_mass)
+        max_sub_mass = Concatenate(self.max_sub_mass)
+        print('len(main_mass):',len(main_mass))
+        print('main_mass:',main_mass)
+        print('len(max_sub_mass):',len((max_sub_mass)))
+
+        mass_largest = max_sub_mass[max_sub_mass >= 10000]
+        print('mass_largest:', mass_largest)
+
+        return {'figure': 'MaxMassComp', 'main_mass': main_mass, 'max_sub_mass': max_sub_mass,
+                'band': MassBand(main_mass, max_sub_mass, self.bands)}
+
+def MaxMassCompPlot(halo_snapshot, bands=False, nproc=1):
+    return HE.Traverse(halo_snapshot, [MaxMassCompAcc(bands)], nproc=nproc)[0]
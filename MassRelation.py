@@ -0,0 +1,107 @@
+import numpy as np
+import HaloEngine as HE
+import HaloHist as HH
+
+# Host / subhalo mass relation with segmented reductions.
+#
+# Host i owns subhalo rows sub_offset[i]:sub_offset[i+1], so per-host sums
+# and maxima are reductions over contiguous segments of subhalo_nPart.
+# BinnedStats summarises y against host mass with per-bin percentiles, so
+# the relation can be drawn as median and scatter bands rather than one
+# marker per host.
+
+def SegmentSum(values, offsets):
+    total = np.zeros(len(values)+1, dtype=np.int64)
+    np.cumsum(values, out=total[1:])
+    return total[offsets[1:]] - total[offsets[:-1]]
+
+def SegmentMax(values, offsets, empty=0):
+    counts = np.diff(offsets)
+    full = counts > 0
+    result = np.full(len(counts), empty, dtype=np.asarray(values).dtype)
+    if np.any(full):
+        result[full] = np.maximum.reduceat(values, offsets[:-1][full])
+    return result
+
+def HostSubMass(halo_nPart, subhalo_nPart, sub_offset):
+    tot_sub_mass = SegmentSum(subhalo_nPart, sub_offset)
+    max_sub_mass = SegmentMax(subhalo_nPart, sub_offset)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sub_fraction = tot_sub_mass/halo_nPart
+        max_fraction = max_sub_mass/halo_nPart
+    return {'main_mass': np.asarray(halo_nPart), 'tot_sub_mass': tot_sub_mass,
+            'max_sub_mass': max_sub_mass, 'sub_fraction': sub_fraction,
+            'max_fraction': max_fraction}
+
+def BinnedStats(x, y, bins=20, percentiles=(16, 50, 84), log=True, x_range=None):
+    # per-bin counts and percentiles of y in bins of x;
+    # empty bins come back as NaN
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    good = np.isfinite(x) & np.isfinite(y)
+    if log:
+        good &= x > 0
+    x = x[good]
+    y = y[good]
+    if x_range is None:
+        x_range = (np.min(x), np.max(x)) if len(x) else (1, 10)
+    # binned like the density histograms, in log10(x) when log
+    if log:
+        axis = HH.FixedHistogram(bins, np.log10(x_range))
+        b = axis.BinIndex(np.log10(x))
+        edges = 10**axis.edges
+    else:
+        axis = HH.FixedHistogram(bins, x_range)
+        b = axis.BinIndex(x)
+        edges = axis.edges
+    inside = (b >= 0) & (b < bins)
+    b = b[inside]
+    y = y[inside]
+
+    order = np.lexsort((y, b))
+    b = b[order]
+    y = y[order]
+    counts = np.bincount(b, minlength=bins)
+    starts = np.zeros(bins, dtype=np.int64)
+    np.cumsum(counts[:-1], out=starts[1:])
+
+    stats = np.full((len(percentiles), bins), np.nan)
+    full = counts > 0
+    for k, q in enumerate(percentiles):
+        # linear interpolation between order statistics, as np.percentile
+        pos = q/100*(counts[full] - 1)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, counts[full] - 1)
+        frac = pos - lo
+        y_lo = y[starts[full] + lo]
+        y_hi = y[starts[full] + hi]
+        stats[k, full] = y_lo + (y_hi - y_lo)*frac
+    return edges, counts, stats
+
+class MassRelationAcc:
+    columns = ['halo_nPart', 'subhalo_nPart']
+
+    def __init__(self, bins=20, percentiles=(16, 50, 84)):
+        self.bins = bins
+        self.percentiles = percentiles
+        self.parts = []
+
+    def Update(self, chunk):
+        self.parts.append(HostSubMass(chunk['halo_nPart'], chunk['subhalo_nPart'], chunk['sub_offset']))
+
+    def Finish(self):
+        # a catalogue without hosts gives no chunks: empty columns then
+        parts = self.parts or [HostSubMass(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32),
+                                           np.zeros(1, dtype=np.int64))]
+        relation = {}
+        for key in parts[0]:
+            relation[key] = np.concatenate([part[key] for part in parts])
+        main_mass = relation['main_mass']
+        for key in ['tot_sub_mass', 'max_sub_mass', 'sub_fraction', 'max_fraction']:
+            edges, counts, stats = BinnedStats(main_mass, relation[key], self.bins, self.percentiles)
+            relation[key+'_bins'] = {'edges': edges, 'counts': counts,
+                                     'percentiles': self.percentiles, 'stats': stats}
+        return relation
+
+def MassRelation(halo_snapshot, bins=20, percentiles=(16, 50, 84), nproc=1):
+    return HE.Traverse(halo_snapshot, [MassRelationAcc(bins, percentiles)], nproc=nproc)[0]
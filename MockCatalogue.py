@@ -0,0 +1,70 @@
+import numpy as np
+import h5py
+import HaloKernels as HK
+
+# Synthetic halos_XXX.hdf5 catalogue in the layout the analyses read:
+#   /Halo_IDs                         host IDs
+#   /i          attrs halo_nPart      0.2 linking length host i
+#   /i/Halo_Pos, /i/Halo_Vel          (halo_nPart, 3) particles
+#   /i/mean_vel                       (3,)
+#   /i/j        attrs subhalo_nPart   0.1 linking length subhalo j of host i
+#   /i/j/subhalo_mean_pos, /i/j/subhalo_mean_vel
+#
+# Host particle counts follow a power-law mass function between nPart_min
+# and nPart_max.  The number of subhalos per host is Poisson with mean
+# `occupancy`, or drawn from explicit probabilities when `occupancy` is a
+# sequence (occupancy[k] = probability of k subhalos).  Each subhalo is a
+# disjoint block of its host's particles, so subhalo means and masses are
+# consistent with the host; subhalo positions are minimum-image means, as
+# particles of hosts near a box face wrap around.
+
+def HostParticleCounts(rng, nHalo, nPart_min, nPart_max, slope):
+    # dN/dn ~ n^-(1+slope) truncated to [nPart_min, nPart_max]
+    u = rng.uniform(size=nHalo)
+    lo = nPart_min**-slope
+    hi = nPart_max**-slope
+    return np.floor((lo - u*(lo - hi))**(-1/slope)).astype(np.int64)
+
+def SubhaloCounts(rng, nHalo, occupancy):
+    if np.ndim(occupancy) == 0:
+        return rng.poisson(occupancy, size=nHalo)
+    p = np.asarray(occupancy, dtype=np.float64)
+    return rng.choice(len(p), size=nHalo, p=p/np.sum(p))
+
+def WriteMockCatalogue(halo_snapshot, nHalo=1000, nPart_min=20, nPart_max=10**4, slope=1.0,
+                       occupancy=1.5, sub_nPart_min=10, box_size=100.0, seed=0):
+    rng = np.random.default_rng(seed)
+    nPart = HostParticleCounts(rng, nHalo, nPart_min, nPart_max, slope)
+    nsub = np.minimum(SubhaloCounts(rng, nHalo, occupancy), nPart//sub_nPart_min)
+    centre = rng.uniform(0, box_size, size=(nHalo, 3))
+    bulk_vel = rng.normal(0, 300, size=(nHalo, 3))
+
+    with h5py.File(halo_snapshot, 'w') as f:
+        f['Halo_IDs'] = np.arange(nHalo, dtype=np.int64)
+        for i in range(0, nHalo):
+            n = int(nPart[i])
+            # radius and dispersion grow as nPart^(1/3)
+            scale = 0.05*n**(1/3)
+            Pos_Halo = (centre[i] + rng.normal(0, scale, size=(n, 3))) % box_size
+            Vel_Halo = bulk_vel[i] + rng.normal(0, 10*scale, size=(n, 3))
+            halo = f.create_group(str(i))
+            halo.attrs['halo_nPart'] = n
+            halo['Halo_Pos'] = Pos_Halo.astype(np.float32)
+            halo['Halo_Vel'] = Vel_Halo.astype(np.float32)
+            halo['mean_vel'] = np.mean(Vel_Halo, axis=0).astype(np.float32)
+
+            if nsub[i] == 0:
+                continue
+            # split the first part of the host into nsub disjoint blocks
+            cuts = np.sort(rng.choice(np.arange(1, n//sub_nPart_min), size=nsub[i]-1, replace=False)) \
+                if nsub[i] > 1 else np.zeros(0, dtype=np.int64)
+            bounds = np.concatenate([[0], cuts, [n//sub_nPart_min]])*sub_nPart_min
+            order = rng.permutation(n)
+            for j in range(0, nsub[i]):
+                members = order[bounds[j]:bounds[j+1]]
+                sub = halo.create_group(str(j))
+                sub.attrs['subhalo_nPart'] = len(members)
+                sub['subhalo_mean_pos'] = HK.SegmentedPeriodicMean(Pos_Halo[members], [0, len(members)], box_size)[0]
+                sub['subhalo_mean_vel'] = np.mean(Vel_Halo[members], axis=0).astype(np.float32)
+
+    return {'nHalo': nHalo, 'nSub': int(np.sum(nsub)), 'nPart': int(np.sum(nPart))}
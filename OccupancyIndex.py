@@ -0,0 +1,96 @@
+import os
+import multiprocessing
+import numpy as np
+import h5py
+import HaloStream as HSt
+import HaloSummary as HS
+import Instrument as IN
+
+# Occupancy index of a halos_XXX.hdf5 catalogue: the number of 0.1 subhalos
+# in every 0.2 host (nHaloSub) and the offset of its first subhalo in the
+# flat subhalo table (sub_offset, length nHalo+1).  It is built from group
+# link metadata only, so no dataset is read, and persisted next to the
+# catalogue as halos_XXX_occupancy.hdf5 (written under HS.TempPath and
+# renamed once complete, as the summary sidecar is).  With nproc > 1 the
+# host range is split over a process pool.
+
+def IndexPath(halo_snapshot):
+    root, ext = os.path.splitext(halo_snapshot)
+    return root + '_occupancy' + ext
+
+def IsFresh(halo_snapshot, index_file):
+    if not os.path.exists(index_file):
+        return False
+    with h5py.File(index_file, 'r') as s:
+        if 'nHaloSub' not in s or 'sub_offset' not in s:
+            return False
+        for key, value in HS.SourceStamp(halo_snapshot).items():
+            if s.attrs.get(key) != value:
+                return False
+    return True
+
+def CountRange(args):
+    # worker: subhalo counts of hosts [first, last), file opened read-only
+    halo_snapshot, first, last = args
+    with HSt.OpenSnapshot(halo_snapshot) as f:
+        return np.array([HSt.CountGroups(f['/'+str(i)]) for i in range(first, last)], dtype=np.int32)
+
+def BuildIndex(halo_snapshot, index_file=None, nproc=1):
+    if index_file is None:
+        index_file = IndexPath(halo_snapshot)
+
+    with IN.Phase('index'), HSt.OpenSnapshot(halo_snapshot) as f:
+        nHalo = HSt.CountHosts(f)
+        nHaloSub = np.empty(nHalo, dtype=np.int32)
+        progress = IN.Progress('occupancy index', nHalo)
+        if nproc > 1:
+            # host ranges on a pool; imap keeps their order
+            ranges = HS.SplitHosts(nHalo, 4*nproc)
+            with multiprocessing.Pool(nproc) as pool:
+                for (a, b), counts in zip(ranges, pool.imap(CountRange, [(halo_snapshot, a, b) for a, b in ranges])):
+                    nHaloSub[a:b] = counts
+                    progress.Update(b)
+        else:
+            for i in range(0, nHalo):
+                nHaloSub[i] = HSt.CountGroups(f['/'+str(i)])
+                progress.Update(i+1)
+        IN.Count('hdf5_objects', nHalo)
+    sub_offset = np.zeros(nHalo+1, dtype=np.int64)
+    np.cumsum(nHaloSub, out=sub_offset[1:])
+
+    with h5py.File(HS.TempPath(index_file), 'w') as s:
+        for key, value in HS.SourceStamp(halo_snapshot).items():
+            s.attrs[key] = value
+        s['nHaloSub'] = nHaloSub
+        s['sub_offset'] = sub_offset
+    os.replace(HS.TempPath(index_file), index_file)
+
+    return index_file
+
+def LoadIndex(halo_snapshot, index_file=None, nproc=1):
+    # a fresh summary sidecar already holds the index
+    summary_file = HS.SummaryPath(halo_snapshot)
+    if HS.IsFresh(halo_snapshot, summary_file):
+        index_file = summary_file
+    else:
+        if index_file is None:
+            index_file = IndexPath(halo_snapshot)
+        if not IsFresh(halo_snapshot, index_file):
+            BuildIndex(halo_snapshot, index_file, nproc)
+    with h5py.File(index_file, 'r') as s:
+        return s['nHaloSub'][()], s['sub_offset'][()]
+
+def SelectHosts(nHaloSub, occupancy_l, occupancy_h):
+    return (occupancy_l <= nHaloSub) & (nHaloSub <= occupancy_h)
+
+def SubRows(sub_offset, select):
+    # rows of the flat subhalo table owned by the selected hosts
+    # (a host mask or sorted host indices)
+    starts = sub_offset[:-1][select]
+    counts = sub_offset[1:][select] - starts
+    first = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return first + np.arange(np.sum(counts))
+
+def OccupancyCounts(nHaloSub):
+    # number of hosts holding 0, 1, 2, ... subhalos
+    return np.bincount(nHaloSub)
@@ -0,0 +1,227 @@
+import os
+import numpy as np
+import h5py
+import HaloSummary as HS
+import HaloStream as HSt
+import Instrument as IN
+
+# Repacked copy of a halos_XXX.hdf5 catalogue with all host particles in
+# one contiguous dataset, halos_XXX_particles.hdf5:
+#   /Halo_Pos, /Halo_Vel        (nPart, 3) float32, host i owns rows
+#   /part_offset                  part_offset[i]:part_offset[i+1]
+#   /halo_nPart, /nHaloSub, /mean_vel            per host
+#   /sub_offset, /subhalo_nPart, /subhalo_mean_pos, /subhalo_mean_vel
+#
+# The particle datasets are chunked along rows and gzip compressed (with
+# the shuffle filter) by default, so compression works across hosts; with
+# compression=None they are stored contiguously instead and the reader
+# memory-maps them.  Like the summary sidecar the store records the size
+# and mtime of its source and is ignored once the catalogue changes, and it
+# is written under a temporary name and renamed once complete, so an
+# interrupted repack never leaves a store that looks fresh.
+#
+# HaloStream reads batches from a fresh store with one slice per column
+# instead of one dataset per host.  ParticleStore gives a single host's
+# particles as views: of the memory map, or of the decompressed
+# chunk-aligned block holding the host, which is reused by its neighbours.
+#
+#   PS.RepackParticles('halos_061.hdf5')
+#   with PS.ParticleStore(PS.StorePath('halos_061.hdf5')) as store:
+#       Pos, Vel = store.Host(17)
+
+STORE_VERSION = 1
+DEFAULT_CHUNK_ROWS = 2**16
+
+PARTICLE_COLUMNS = ['Halo_Pos', 'Halo_Vel']
+HOST_COLUMNS = ['halo_nPart', 'nHaloSub', 'mean_vel']
+SUB_COLUMNS = ['subhalo_nPart', 'subhalo_mean_pos', 'subhalo_mean_vel']
+
+def StorePath(halo_snapshot):
+    root, ext = os.path.splitext(halo_snapshot)
+    return root + '_particles' + ext
+
+def IsFresh(halo_snapshot, store_file=None):
+    if store_file is None:
+        store_file = StorePath(halo_snapshot)
+    if not os.path.exists(store_file):
+        return False
+    stamp = HS.SourceStamp(halo_snapshot)
+    with h5py.File(store_file, 'r') as s:
+        if s.attrs.get('store_version', -1) != STORE_VERSION:
+            return False
+        for key, value in stamp.items():
+            if s.attrs.get(key) != value:
+                return False
+    return True
+
+def HostCounts(f):
+    # particles and subhalos of every host, from dataset shapes and links only
+    nHalo = HSt.CountHosts(f)
+    nPart = np.zeros(nHalo, dtype=np.int64)
+    nsub = np.zeros(nHalo, dtype=np.int64)
+    for i in range(0, nHalo):
+        halo = f['/'+str(i)]
+        nPart[i] = halo['Halo_Pos'].shape[0]
+        nsub[i] = HSt.CountGroups(halo)
+    IN.Count('hdf5_objects', 2*nHalo)
+    return nPart, nsub
+
+def Offsets(counts):
+    offset = np.zeros(len(counts)+1, dtype=np.int64)
+    np.cumsum(counts, out=offset[1:])
+    return offset
+
+def RepackParticles(halo_snapshot, store_file=None, compression='gzip', compression_opts=4,
+                    chunk_rows=None, memory_budget=None):
+    if store_file is None:
+        store_file = StorePath(halo_snapshot)
+    if chunk_rows is None:
+        chunk_rows = DEFAULT_CHUNK_ROWS
+
+    with HSt.OpenSnapshot(halo_snapshot) as f:
+        with IN.Phase('plan'):
+            nPart, nsub = HostCounts(f)
+    part_offset = Offsets(nPart)
+    sub_offset = Offsets(nsub)
+    nHalo = len(nPart)
+
+    with h5py.File(HS.TempPath(store_file), 'w') as s:
+        s.attrs['store_version'] = STORE_VERSION
+        s.attrs['source'] = os.path.abspath(halo_snapshot)
+        for key, value in HS.SourceStamp(halo_snapshot).items():
+            s.attrs[key] = value
+        s['part_offset'] = part_offset
+        s['sub_offset'] = sub_offset
+
+        layout = {}
+        if compression is not None and part_offset[-1] > 0:
+            layout = {'chunks': (int(min(chunk_rows, part_offset[-1])), 3), 'shuffle': True,
+                      'compression': compression, 'compression_opts': compression_opts}
+        for key in PARTICLE_COLUMNS:
+            s.create_dataset(key, (part_offset[-1], 3), dtype=np.float32, **layout)
+        s.create_dataset('halo_nPart', (nHalo,), dtype=np.int32)
+        s.create_dataset('nHaloSub', (nHalo,), dtype=np.int32)
+        s.create_dataset('mean_vel', (nHalo, 3), dtype=np.float32)
+        s.create_dataset('subhalo_nPart', (sub_offset[-1],), dtype=np.int32)
+        s.create_dataset('subhalo_mean_pos', (sub_offset[-1], 3), dtype=np.float32)
+        s.create_dataset('subhalo_mean_vel', (sub_offset[-1], 3), dtype=np.float32)
+
+        progress = IN.Progress('repack', nHalo)
+        for batch in HSt.IterRawBatches(halo_snapshot, memory_budget):
+            a, b = batch['first'], batch['last']
+            with IN.Phase('write'):
+                for key in PARTICLE_COLUMNS:
+                    s[key][part_offset[a]:part_offset[b]] = batch[key]
+                for key in HOST_COLUMNS:
+                    s[key][a:b] = batch[key]
+                for key in SUB_COLUMNS:
+                    s[key][sub_offset[a]:sub_offset[b]] = batch[key]
+            progress.Update(b)
+    os.replace(HS.TempPath(store_file), store_file)
+
+    print('nHalo:', nHalo)
+    print('nPart:', int(part_offset[-1]))
+    return store_file
+
+def PlanStoreBatches(part_offset, first=0, last=None, memory_budget=None, batch_size=None):
+    # same budget rule as HSt.PlanBatches, from the stored offsets
+    if memory_budget is None:
+        memory_budget = HSt.DEFAULT_MEMORY_BUDGET
+    if last is None:
+        last = len(part_offset) - 1
+    host_bytes = np.diff(part_offset)*len(PARTICLE_COLUMNS)*3*4*HSt.KERNEL_OVERHEAD
+    cum_bytes = np.concatenate([[0], np.cumsum(host_bytes)])
+    batches = []
+    a = first
+    while a < last:
+        # furthest b with the particles of [a, b) inside the budget, at least one host
+        b = int(np.searchsorted(cum_bytes, cum_bytes[a] + memory_budget, side='right')) - 1
+        b = max(b, a+1)
+        if batch_size is not None:
+            b = min(b, a + batch_size)
+        b = min(b, last)
+        batches.append((a, b))
+        a = b
+    return batches
+
+def ReadStoreBatch(s, part_offset, sub_offset, a, b):
+    p0, p1 = part_offset[a], part_offset[b]
+    s0, s1 = sub_offset[a], sub_offset[b]
+    batch = {'first': a, 'last': b,
+             'part_offset': part_offset[a:b+1] - p0,
+             'sub_offset': sub_offset[a:b+1] - s0}
+    for key in PARTICLE_COLUMNS:
+        batch[key] = s[key][p0:p1]
+    for key in HOST_COLUMNS:
+        batch[key] = s[key][a:b]
+    for key in SUB_COLUMNS:
+        batch[key] = s[key][s0:s1]
+    IN.Count('hdf5_objects', len(PARTICLE_COLUMNS) + len(HOST_COLUMNS) + len(SUB_COLUMNS))
+    IN.Count('bytes_read', sum(batch[key].nbytes for key in PARTICLE_COLUMNS + HOST_COLUMNS + SUB_COLUMNS))
+    return batch
+
+def IterStoreBatches(store_file, memory_budget=None, batch_size=None, first=0, last=None):
+    with h5py.File(store_file, 'r', rdcc_nbytes=4*2**20) as s:
+        part_offset = s['part_offset'][()]
+        sub_offset = s['sub_offset'][()]
+        with IN.Phase('plan'):
+            batches = PlanStoreBatches(part_offset, first, last, memory_budget, batch_size)
+        for a, b in batches:
+            with IN.Phase('read'):
+                batch = ReadStoreBatch(s, part_offset, sub_offset, a, b)
+            yield batch
+
+class ParticleStore:
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self.f = h5py.File(store_file, 'r')
+        self.part_offset = self.f['part_offset'][()]
+        self.sub_offset = self.f['sub_offset'][()]
+        self.nHalo = len(self.part_offset) - 1
+        self.maps = {}
+        self.block = None
+        for key in PARTICLE_COLUMNS:
+            ds = self.f[key]
+            offset = ds.id.get_offset() if ds.chunks is None else None
+            if offset is not None:
+                # contiguous and allocated: map the file directly
+                self.maps[key] = np.memmap(store_file, dtype=ds.dtype, mode='r', offset=offset, shape=ds.shape)
+        self.chunk_rows = self.f[PARTICLE_COLUMNS[0]].chunks[0] if not self.maps else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.maps = {}
+        self.block = None
+        self.f.close()
+
+    def Block(self, p0, p1):
+        # decompressed chunk-aligned rows covering [p0, p1), kept for the next host
+        if self.block is None or p0 < self.block[0] or p1 > self.block[1]:
+            b0 = (p0//self.chunk_rows)*self.chunk_rows
+            b1 = min(-(-p1//self.chunk_rows)*self.chunk_rows, self.part_offset[-1])
+            with IN.Phase('read'):
+                arrays = [self.f[key][b0:b1] for key in PARTICLE_COLUMNS]
+            for x in arrays:
+                x.flags.writeable = False
+            IN.Count('bytes_read', sum(x.nbytes for x in arrays))
+            self.block = (b0, b1, arrays)
+        return self.block
+
+    def Host(self, i):
+        # (Halo_Pos, Halo_Vel) of host i as read-only views
+        p0, p1 = int(self.part_offset[i]), int(self.part_offset[i+1])
+        if self.maps:
+            return tuple(self.maps[key][p0:p1] for key in PARTICLE_COLUMNS)
+        if p1 == p0:
+            return tuple(np.zeros((0, 3), dtype=np.float32) for key in PARTICLE_COLUMNS)
+        b0, b1, arrays = self.Block(p0, p1)
+        return tuple(x[p0-b0:p1-b0] for x in arrays)
+
+    def Range(self, a, b):
+        # HaloStream-style batch of hosts [a, b), in bulk reads
+        return ReadStoreBatch(self.f, self.part_offset, self.sub_offset, a, b)
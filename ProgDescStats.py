@@ -0,0 +1,91 @@
+import os
+import numpy as np
+
+# Progenitor / descendant count statistics of TreeStore forests.
+#
+# Every snapshot's edges are flattened to (halo row, linked ID) pairs and
+# counted with bincount, so the numbers of progenitors and descendants of
+# every halo in the forest come out of a few array operations.  Results
+# are cached per store and cutoff in derived/progdesc_cutoff=<c>.npz, so
+# the 0.1 and 0.2 linking-length forests can be compared repeatedly
+# without retraversing either.
+
+def EdgeOwners(offset):
+    # row owning every edge of a CSR edge list
+    offset = np.asarray(offset)
+    return np.repeat(np.arange(len(offset)-1), np.diff(offset))
+
+def SnapshotCounts(store, snap):
+    nHalo = len(store.HaloIDs(snap))
+    prog_offset, prog_ids = store.Edges(snap, 'prog')
+    desc_offset, desc_ids = store.Edges(snap, 'desc')
+    nProg = np.bincount(EdgeOwners(prog_offset), minlength=nHalo)
+    nDesc = np.bincount(EdgeOwners(desc_offset), minlength=nHalo)
+    return nProg, nDesc
+
+def ProgDescCounts(store, cutoff=None):
+    # per-halo progenitor and descendant counts over the whole forest;
+    # halos below `cutoff` particles are masked out
+    cache = store.DerivedPath('progdesc_cutoff='+str(cutoff)+'.npz')
+    if os.path.exists(cache):
+        with np.load(cache) as saved:
+            return {key: saved[key] for key in saved.files}
+
+    nProg = []
+    nDesc = []
+    snap_index = []
+    for k, snap in enumerate(store.snapshots):
+        p, d = SnapshotCounts(store, snap)
+        nProg.append(p)
+        nDesc.append(d)
+        snap_index.append(np.full(len(p), k, dtype=np.int32))
+    counts = {'nProg': np.concatenate(nProg), 'nDesc': np.concatenate(nDesc),
+              'snap_index': np.concatenate(snap_index),
+              'nPart': np.concatenate([np.asarray(store.nPart(snap)) for snap in store.snapshots])}
+    keep = np.ones(len(counts['nPart']), dtype=bool)
+    if cutoff is not None:
+        keep = counts['nPart'] >= cutoff
+    counts['keep'] = keep
+
+    prog_hist, desc_hist = CountHist(counts)
+    counts['prog_hist'] = prog_hist
+    counts['desc_hist'] = desc_hist
+    store.SaveDerived('progdesc_cutoff='+str(cutoff)+'.npz', counts)
+    return counts
+
+def CountHist(counts):
+    # number of halos with 0, 1, 2, ... progenitors and descendants;
+    # halos in the first snapshot cannot have progenitors and halos in the
+    # last cannot have descendants, so they are left out of those histograms
+    keep = counts['keep']
+    last = np.max(counts['snap_index'])
+    prog_hist = np.bincount(counts['nProg'][keep & (counts['snap_index'] > 0)])
+    desc_hist = np.bincount(counts['nDesc'][keep & (counts['snap_index'] < last)])
+    return prog_hist, desc_hist
+
+def CountStats(counts):
+    keep = counts['keep']
+    nProg = counts['nProg'][keep]
+    nDesc = counts['nDesc'][keep]
+    return {'nHalo': int(np.sum(keep)),
+            'total_prog': int(np.sum(nProg)), 'total_desc': int(np.sum(nDesc)),
+            'mean_prog': float(np.mean(nProg)) if len(nProg) else np.nan,
+            'mean_desc': float(np.mean(nDesc)) if len(nDesc) else np.nan,
+            'max_prog': int(np.max(nProg, initial=0)), 'max_desc': int(np.max(nDesc, initial=0)),
+            'mergers': int(np.sum(nProg > 1)), 'splits': int(np.sum(nDesc > 1))}
+
+def PadHists(hists):
+    n = max(len(h) for h in hists)
+    return [np.pad(h, (0, n - len(h))) for h in hists]
+
+def ProgDescCompare(store_1, store_2, cutoff=None, labels=('0.1', '0.2')):
+    # both linking lengths in one call: per-halo counts, histograms padded
+    # to a common length and summary statistics
+    result = {}
+    counts = [ProgDescCounts(store_1, cutoff), ProgDescCounts(store_2, cutoff)]
+    prog_hists = PadHists([c['prog_hist'] for c in counts])
+    desc_hists = PadHists([c['desc_hist'] for c in counts])
+    for label, c, prog_hist, desc_hist in zip(labels, counts, prog_hists, desc_hists):
+        result[label] = {'counts': c, 'prog_hist': prog_hist, 'desc_hist': desc_hist,
+                         'stats': CountStats(c)}
+    return result
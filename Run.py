@@ -7,6 +7,21 @@ import MassComp as MC
 import SubHaloPos as SHP
 import SubHaloVel as SHV
 import SubPosVel as SPV
+import HaloSummary as HS
+import HaloEngine as HE
+import OccupancyIndex as OI
+import MassRelation as MR
+import TreeStore as TS
+import MainBranch as MB
+import ProgDescStats as PDS
+import HaloMatch as HM
+import BatchDriver as BD
+import HaloPlots as HP
+import SpatialIndex as SI
+import ParticleStore as PS
+import QuantileSketch as QS
+import FOFFinder as FOF
+import Catalogue as CA
 import pickle
 import numpy
 
@@ -21,9 +36,18 @@ import numpy
 #with open('snapdatatime.pck', 'rb') as pfile3:
 #    snap_data = pickle.load(pfile3)
 
+#One-off conversion of the pickles to memory-mapped columnar stores
+#TS.ConvertPickle('treedata.pck', 'treestore', snap_pickle='snapdatatime.pck')
+#TS.ConvertPickle('treedata10.pck', 'treestore10', snap_pickle='snapdatatime.pck')
+
+#tree_store_1 = TS.TreeStore('treestore')
+#tree_store_2 = TS.TreeStore('treestore10')
+
 
 #lMg.mainLogM(tree_data, snap_data, cutoff=10)
 
+#branches = MB.MainBranchStats(tree_store_1, cutoff=1000)
+
 #mf.mainmfluc(tree_data, snap_data, cutoff=1000)
 
 #mBL.mainBranchLengthCompPlot(tree_data, cutoff=None)
@@ -36,22 +60,63 @@ import numpy
 
 #PDH.progdeschistComp(tree_data_1, tree_data_2, cutoff=1000)
 
+#prog_desc = PDS.ProgDescCompare(tree_store_1, tree_store_2, cutoff=1000)
+
 #lMg.mainLogMComp(tree_data_1, tree_data_2, snap_data, cutoff=1000)
 
 #mf.mainmflucComp (tree_data_1, tree_data_2, snap_data, cutoff=1000)
 
-#MC.SumMassCompPlot(halo_snapshot='halos_061.hdf5')
+#FOF.RunFOF('halos_061.hdf5', Pos, Vel, box_size=100.0, nproc=16)
+
+#PS.RepackParticles(halo_snapshot='halos_061.hdf5')
+
+#HS.ExtractSummary(halo_snapshot='halos_061.hdf5', nproc=8)
+
+#results = HE.Traverse('halos_061.hdf5', [MC.SumMassCompAcc(), MC.MaxMassCompAcc(), MC.NumOcupAcc(),
+#                                         SHP.SubHaloPosAcc(2, 4), SHP.SubHaloPosCompAcc([(0, 1), (2, 4)]),
+#                                         SHV.SubHaloVelAcc(0, 1), SHV.SubHaloVelCompAcc([(0, 1), (2, 4), (5, 10)]),
+#                                         SPV.SubHaloPosVelAcc(0, 1)])
+#HP.RenderAll(results, nproc=8)
+
+#HP.Render(MC.SumMassCompPlot(halo_snapshot='halos_061.hdf5'))
+
+#HP.Render(SHP.SubHaloPos(halo_snapshot= 'halos_061.hdf5', occupancy_l=2, occupancy_h=4))
+
+#HP.Render(SHP.SubHaloPosComp(halo_snapshot='halos_061.hdf5', occupancy1_l=0, occupancy1_h=1, occupancy2_l=2, occupancy2_h=4))
+
+#HP.Render(SHP.SubHaloPosComp(halo_snapshot='halos_061.hdf5', occupancies=[(0, 1), (2, 4), (5, 10)]))
+
+#HP.Render(SHP.SubHaloPosComp(halo_snapshot='halos_061.hdf5', box_size=100.0))
+
+#HP.Render(SHV.SubHaloVel(halo_snapshot= 'halos_061.hdf5', occupancy_l=0, occupancy_h=1))
+
+#HP.Render(SHP.SubHaloPosQuery(halo_snapshot='halos_061.hdf5', occupancy_l=6, occupancy_h=8))
+
+#cat = CA.Catalogue('halos_061.hdf5')
+#largest = cat.subs.Where(cat.subs.nPart >= 10000).Read('nPart', 'host.nPart', 'host_row')
+
+#HP.Render(SHV.SubHaloVelComp(halo_snapshot= 'halos_061.hdf5', occupancy1_l=0, occupancy1_h=1, occupancy2_l=2, occupancy2_h=4))
+
+#OI.BuildIndex(halo_snapshot='halos_061.hdf5')
+
+#match = HM.LoadMatch(halo_snapshot='halos_061.hdf5')
+
+#HP.Render(MC.NumOcup(halo_snapshot='halos_061.hdf5'))
+
+#HP.Render(MC.MaxMassCompPlot(halo_snapshot='halos_061.hdf5'))
 
-#SHP.SubHaloPos(halo_snapshot= 'halos_061.hdf5', occupancy_l=2, occupancy_h=4)
+#HP.Render(MC.MaxMassCompPlot(halo_snapshot='halos_061.hdf5', bands=True))
 
-#SHP.SubHaloPosComp(halo_snapshot='halos_061.hdf5', occupancy1_l=0, occupancy1_h=1, occupancy2_l=2, occupancy2_h=4)
+#mass_relation = MR.MassRelation(halo_snapshot='halos_061.hdf5', bins=20)
 
-#SHV.SubHaloVel(halo_snapshot= 'halos_061.hdf5', occupancy_l=0, occupancy_h=1)
+#profile = SI.RadialProfile(halo_snapshot='halos_061.hdf5', r_edges=numpy.linspace(0, 2, 21), box_size=100.0)
 
-#SHV.SubHaloVelComp(halo_snapshot= 'halos_061.hdf5', occupancy1_l=0, occupancy1_h=1, occupancy2_l=2, occupancy2_h=4)
+#sketches = QS.RatioSketches(halo_snapshot='halos_061.hdf5', occupancies=[(0, 1), (2, 4)], k=400)
+#print(sketches['pos_ratio'][1].Quantile([0.16, 0.5, 0.84]))
 
-#MC.NumOcup(halo_snapshot='halos_061.hdf5')
+#results = BD.RunSnapshots(range(0, 62), redshifts={snap: TS.SnapTime(snap_data[snap], 'z') for snap in snap_data}, nproc=16)
+#HP.Render(BD.TimeSeriesFigure(BD.TimeSeries(results)))
 
-#MC.MaxMassCompPlot(halo_snapshot='halos_061.hdf5')
+#HP.Render(SPV.SubHaloPosVel(halo_snapshot='halos_061.hdf5', occupancy_l=0, occupancy_h=1, density=True, bins=100))
 
-SPV.SubHaloPosVel(halo_snapshot='halos_061.hdf5', occupancy_l=0, occupancy_h=1)
+HP.Render(SPV.SubHaloPosVel(halo_snapshot='halos_061.hdf5', occupancy_l=0, occupancy_h=1))
@@ -0,0 +1,235 @@
+import numpy as np
+import HaloSummary as HS
+import HaloKernels as HK
+import HaloStream as HSt
+import ArrayCache as AC
+import HaloHist as HH
+
+# Cell list over a periodic box for host-centric subhalo statistics.
+#
+# Points are wrapped into [0, box_size) and sorted by cell.  Only occupied
+# cells are stored: cell_keys holds their flat cell numbers in increasing
+# order and the k-th of them holds rows order[cell_offset[k]:cell_offset[k+1]],
+# found with searchsorted, so memory does not depend on the number of
+# cells and cells can stay as small as asked for at any N.  A query visits,
+# for every centre, the cells within r, and measures minimum-image
+# distances, so halos across a box face are found.  Centres are handled in batches and
+# each batch is one set of array operations per neighbour-cell shift.
+#
+# Query results are CSR: centre k's matches are index[offset[k]:offset[k+1]]
+# (rows of the indexed points) with their distances, in increasing distance.
+#
+# Snapshot helpers index the subhalo_mean_pos of a catalogue and measure
+# from the host centres of HostGeometry: the minimum-image mean of the host
+# particles for the given box_size (a plain mean lands mid-box for a host
+# split across a box face) and the host-centric radius, the largest
+# particle distance from that centre.  Both come from one pass over the
+# particles, kept in the array cache.  HostCentricRatio gives the SubHalo*
+# position histograms subhalo distances in units of that radius.
+#   within = SI.SubhalosWithin('halos_061.hdf5', r=1.0, box_size=100.0)
+#   profile = SI.RadialProfile('halos_061.hdf5', np.linspace(0, 2, 21), box_size=100.0)
+# Both also see subhalos of other groups, flagged by `nested`.
+
+DEFAULT_BATCH = 2**16
+POINTS_PER_CELL = 4
+# cells per side; keeps flat cell numbers inside int64
+MAX_CELLS = 2**20
+
+def PeriodicDelta(a, b, box_size):
+    # minimum-image separation b - a
+    d = np.asarray(b, dtype=np.float64) - np.asarray(a, dtype=np.float64)
+    d -= box_size*np.round(d/box_size)
+    return d
+
+def PeriodicDistance(a, b, box_size):
+    return np.sqrt(np.sum(np.square(PeriodicDelta(a, b, box_size)), axis=-1))
+
+class CellList:
+    def __init__(self, positions, box_size, cell_size=None):
+        self.box_size = float(box_size)
+        self.positions = np.mod(np.asarray(positions, dtype=np.float64), self.box_size)
+        n = len(self.positions)
+        if cell_size is None:
+            ncell = int(np.cbrt(max(n, 1)/POINTS_PER_CELL))
+        else:
+            ncell = int(self.box_size//cell_size)
+        self.ncell = min(max(ncell, 1), MAX_CELLS)
+        self.cell_size = self.box_size/self.ncell
+
+        cell = self.CellOf(self.positions)
+        self.order = np.argsort(cell, kind='stable')
+        self.cell_keys, first = np.unique(cell[self.order], return_index=True)
+        self.cell_offset = np.append(first, n).astype(np.int64)
+
+    def CellCoords(self, positions):
+        coords = np.floor(np.mod(positions, self.box_size)/self.cell_size).astype(np.int64)
+        return np.minimum(coords, self.ncell-1)
+
+    def Key(self, coords):
+        return (coords[:, 0]*self.ncell + coords[:, 1])*self.ncell + coords[:, 2]
+
+    def CellOf(self, positions):
+        return self.Key(self.CellCoords(positions))
+
+    def OccupiedCoords(self):
+        return np.stack(np.unravel_index(self.cell_keys, (self.ncell,)*3), axis=1)
+
+    def CellRange(self, cell):
+        # first row in `order` and number of points of every cell, 0 if empty
+        if len(self.cell_keys) == 0:
+            return np.zeros(len(cell), dtype=np.int64), np.zeros(len(cell), dtype=np.int64)
+        k = np.minimum(np.searchsorted(self.cell_keys, cell), len(self.cell_keys)-1)
+        found = self.cell_keys[k] == cell
+        start = np.where(found, self.cell_offset[k], 0)
+        count = np.where(found, self.cell_offset[k+1] - self.cell_offset[k], 0)
+        return start, count
+
+    def Shifts(self, r):
+        # neighbour-cell shifts covering radius r, each cell visited once
+        span = int(np.ceil(r/self.cell_size))
+        if 2*span + 1 >= self.ncell:
+            axis = np.arange(self.ncell)
+        else:
+            axis = np.arange(-span, span+1)
+        return np.array(np.meshgrid(axis, axis, axis, indexing='ij')).reshape(3, -1).T
+
+    def Gather(self, coords, shift):
+        # (owner, row) of every point in the cell at coords + shift, owner
+        # being the position in coords
+        start, count = self.CellRange(self.Key(np.mod(coords + shift, self.ncell)))
+        total = int(np.sum(count))
+        if total == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        owner = np.repeat(np.arange(len(coords)), count)
+        first = np.zeros(len(count), dtype=np.int64)
+        np.cumsum(count[:-1], out=first[1:])
+        rows = self.order[np.repeat(start, count) + np.arange(total) - np.repeat(first, count)]
+        return owner, rows
+
+    def QueryBatch(self, centres, r):
+        coords = self.CellCoords(centres)
+        parts_centre = []
+        parts_index = []
+        for shift in self.Shifts(r):
+            owner, rows = self.Gather(coords, shift)
+            if len(rows) == 0:
+                continue
+            parts_centre.append(owner)
+            parts_index.append(rows)
+        if not parts_centre:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        owner = np.concatenate(parts_centre)
+        rows = np.concatenate(parts_index)
+        distance = PeriodicDistance(centres[owner], self.positions[rows], self.box_size)
+        keep = distance <= r
+        return owner[keep], rows[keep], distance[keep]
+
+    def Query(self, centres, r, batch=None):
+        # all indexed points within r of every centre, as CSR
+        if batch is None:
+            batch = DEFAULT_BATCH
+        centres = np.atleast_2d(np.asarray(centres, dtype=np.float64))
+        owners, index, distance = [], [], []
+        for a in range(0, len(centres), batch):
+            owner, rows, d = self.QueryBatch(centres[a:a+batch], r)
+            owners.append(owner + a)
+            index.append(rows)
+            distance.append(d)
+        owner = np.concatenate(owners) if owners else np.zeros(0, dtype=np.int64)
+        index = np.concatenate(index) if index else np.zeros(0, dtype=np.int64)
+        distance = np.concatenate(distance) if distance else np.zeros(0)
+        order = np.lexsort((distance, owner))
+        offset = np.zeros(len(centres)+1, dtype=np.int64)
+        np.cumsum(np.bincount(owner, minlength=len(centres)), out=offset[1:])
+        return offset, index[order], distance[order]
+
+    def Count(self, centres, r, batch=None):
+        offset, index, distance = self.Query(centres, r, batch)
+        return np.diff(offset)
+
+    def RadialCounts(self, centres, r_edges, batch=None):
+        # (n_centres, n_bins) point counts in the shells r_edges[k]..r_edges[k+1]
+        r_edges = np.asarray(r_edges, dtype=np.float64)
+        nbins = len(r_edges) - 1
+        offset, index, distance = self.Query(centres, r_edges[-1], batch)
+        owner = np.repeat(np.arange(len(offset)-1), np.diff(offset))
+        b = HH.EdgeIndex(r_edges, distance)
+        inside = (b >= 0) & (b < nbins)
+        counts = np.bincount(owner[inside]*nbins + b[inside], minlength=(len(offset)-1)*nbins)
+        return counts.reshape(len(offset)-1, nbins)
+
+def HostGeometry(halo_snapshot, box_size, memory_budget=None):
+    # Halo_Centre and Halo_Radius of every host, NaN for hosts without particles
+    def compute():
+        centres = []
+        radii = []
+        for batch in HSt.IterHostBatches(halo_snapshot, memory_budget):
+            centre = HK.SegmentedPeriodicMean(batch['Halo_Pos'], batch['part_offset'], box_size)
+            centres.append(centre)
+            radii.append(HK.SegmentedPeriodicRadius(batch['Halo_Pos'], batch['part_offset'], centre, box_size))
+        if not centres:
+            return {'Halo_Centre': np.zeros((0, 3), dtype=np.float32), 'Halo_Radius': np.zeros(0, dtype=np.float32)}
+        return {'Halo_Centre': np.concatenate(centres), 'Halo_Radius': np.concatenate(radii)}
+    return AC.Cached(halo_snapshot, 'HostGeometry', {'box_size': float(box_size)}, compute)
+
+def HostCentres(halo_snapshot, box_size, memory_budget=None):
+    return HostGeometry(halo_snapshot, box_size, memory_budget)['Halo_Centre']
+
+class HostCentricRatio:
+    # func(chunk) for the SubHalo* occupancy histograms: distance of every
+    # subhalo from its periodic host centre over the host-centric radius,
+    # with the occupancy of its host
+    def __init__(self, halo_snapshot, box_size):
+        geometry = HostGeometry(halo_snapshot, box_size)
+        self.centre = geometry['Halo_Centre']
+        self.radius = geometry['Halo_Radius']
+        self.box_size = float(box_size)
+        # names the cache entries built from it, which depend on the box
+        self.__name__ = 'HostCentricRatio_box=' + repr(self.box_size)
+
+    def __call__(self, chunk):
+        host = HS.SubHost(chunk)
+        rows = chunk['first'] + host
+        distance = PeriodicDistance(self.centre[rows], chunk['subhalo_mean_pos'], self.box_size)
+        return distance/self.radius[rows], chunk['nHaloSub'][host]
+
+def PeriodicSummary(halo_snapshot, box_size):
+    # subhalo positions and periodic host centres of a catalogue
+    summary = HS.LoadSummary(halo_snapshot, ['subhalo_mean_pos'])
+    summary['Halo_Centre'] = HostCentres(halo_snapshot, box_size)
+    return summary
+
+def HostCentricRadii(halo_snapshot, box_size):
+    # distance of every nested subhalo from its own host centre
+    summary = PeriodicSummary(halo_snapshot, box_size)
+    host = HS.SubHost(summary)
+    return PeriodicDistance(summary['Halo_Centre'][host], summary['subhalo_mean_pos'], box_size)
+
+def SubhaloIndex(summary, box_size, cell_size=None):
+    return CellList(summary['subhalo_mean_pos'], box_size, cell_size)
+
+def SubhalosWithin(halo_snapshot, r, box_size, hosts=None, cell_size=None):
+    # subhalo rows within r of each host centre, nested in it or not
+    summary = PeriodicSummary(halo_snapshot, box_size)
+    if hosts is None:
+        hosts = np.arange(len(summary['Halo_Centre']))
+    index = SubhaloIndex(summary, box_size, cell_size)
+    offset, rows, distance = index.Query(summary['Halo_Centre'][hosts], r)
+    owner = np.repeat(np.asarray(hosts), np.diff(offset))
+    nested = HS.SubHost(summary)[rows] == owner
+    return {'hosts': np.asarray(hosts), 'offset': offset, 'sub_rows': rows,
+            'distance': distance, 'nested': nested}
+
+def RadialProfile(halo_snapshot, r_edges, box_size, hosts=None, cell_size=None):
+    # mean number density of subhalos around the host centres, all subhalos
+    # and those nested in the host, stacked over hosts
+    within = SubhalosWithin(halo_snapshot, np.max(r_edges), box_size, hosts, cell_size)
+    r_edges = np.asarray(r_edges, dtype=np.float64)
+    nHost = len(within['hosts'])
+    shell = 4/3*np.pi*np.diff(r_edges**3)
+    profile = {'r_edges': r_edges, 'nHost': nHost}
+    for key, select in [('all', np.ones(len(within['distance']), dtype=bool)), ('nested', within['nested'])]:
+        counts, edges = np.histogram(within['distance'][select], r_edges)
+        profile[key+'_counts'] = counts
+        profile[key+'_density'] = counts/(max(nHost, 1)*shell)
+    return profile
@@ -1,160 +1,152 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import h5py
-
-def SubHaloPos(halo_snapshot, occupancy_l, occupancy_h):
-    f=h5py.File(halo_snapshot, 'r', driver='core')
-    nHalo = len([item for item in f.values() if isinstance(item, h5py.Group)])
-    nHaloSub=np.empty(nHalo,dtype=np.int32)
-    Halo_Pos =  np.empty(nHalo,dtype=np.float32)
-    halo_pos =  np.empty(nHalo,dtype=np.float32)
-    
-    progress = -1
-    iSub=0
-    nSub=0
-    for i in range(0,nHalo):
-        previous_progress = progress
-        progress = int(i/nHalo * 100)
-        if progress != previous_progress:
-            print('Progress main_IDs: ', progress, '%')
-        nhalosub = len([item for item in f['/'+str(i)].values() if isinstance(item, h5py.Group)])
-        Pos_Halo=f['/'+str(i)+'/'+'Halo_Pos'].value
-        halo_pos =  np.empty(len(Pos_Halo),dtype=np.float32)
-        for j in range (0, len(Pos_Halo)):
-            halo_pos[j]= np.sqrt(np.power(Pos_Halo[j,0],2,dtype=np.float32) + np.power(Pos_Halo[j,1],2,dtype=np.float32) +np.power(Pos_Halo[j,2],2,dtype=np.float32), dtype=np.float32)
-        max_halo_pos = np.max(halo_pos)
-        Halo_Pos[i]= max_halo_pos
-        if occupancy_l <= nhalosub and nhalosub <= occupancy_h:
-            nHaloSub[i] = nhalosub 
-    nSub=np.sum(nHaloSub)
-
-    Sub_Halo_Pos = np.empty(nSub,dtype=np.float32)
-    Ratio = np.empty(nSub,dtype=np.float32)
-     
-    progress = -1
-    for i in range(0, nHalo):
-        previous_progress = progress
-        progress = int(i/nHalo * 100)
-        if progress != previous_progress:
-            print('Progress sub_IDs: ', progress, '%')
-        for j in range(0,nHaloSub[i]):
-            Pos_Sub=f['/'+str(i)+'/'+str(j)+'/subhalo_mean_pos'].value
-            Sub_Halo_Pos = np.sqrt(np.power(Pos_Sub[0],2,dtype=np.float32) + np.power(Pos_Sub[1],2,dtype=np.float32) +np.power(Pos_Sub[2],2,dtype=np.float32), dtype=np.float32)
-            Ratio[iSub] = Sub_Halo_Pos/Halo_Pos[i]
-            iSub += 1
-  
-    Ratio =  Ratio[~np.isnan(Ratio)]
-    
-    bins = 50
-
-    H , bin_edge = np.histogram(Ratio, bins, density=True)
-
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-
-    ax.plot(bin_edge[:-1], H , color='r')
-    ax.grid(True)
-    ax.set_xlim(0,1)
-   
-    plt.title('Positions of Sub-halos of occupancy '+ str(occupancy_l)+'-'+ str(occupancy_h)+ ' compared to the Main Halos centre')
-    ax.set_xlabel('Sub-Halo position from Main Halo centre divide by radius of Main Halo ')
-    ax.set_ylabel('Density')
-
-    plt.savefig('Plots/SubHaloPos_Occ='+str(occupancy_l)+'-'+str(occupancy_h)+'.png', dpi=fig.dpi)
-
-    plt.clf()
-    
-    return
-
-def SubHaloPosComp (halo_snapshot, occupancy1_l, occupancy1_h, occupancy2_l, occupancy2_h):
-    f=h5py.File(halo_snapshot, 'r', driver='core')
-    nHalo = len([item for item in f.values() if isinstance(item, h5py.Group)])
-    nHaloSub_1=np.empty(nHalo,dtype=np.int32)
-    nHaloSub_2=np.empty(nHalo,dtype=np.int32)
-    Halo_Pos =  np.empty(nHalo,dtype=np.float32)
-    halo_pos =  np.empty(nHalo,dtype=np.float32)
-
-    progress = -1
-    nSub_1=0
-    nSub_2=0
-    for i in range(0,nHalo):
-        previous_progress = progress
-        progress = int(i/nHalo * 100)
-        if progress != previous_progress:
-            print('Progress main_IDs: ', progress, '%')
-        nhalosub = len([item for item in f['/'+str(i)].values() if isinstance(item, h5py.Group)])
-        Pos_Halo=f['/'+str(i)+'/'+'Halo_Pos'].value
-        halo_pos =  np.empty(len(Pos_Halo),dtype=np.float32)
-        for j in range (0, len(Pos_Halo)):
-            halo_pos[j]= np.sqrt(np.power(Pos_Halo[j,0],2,dtype=np.float32) + np.power(Pos_Halo[j,1],2,dtype=np.float32) +np.power(Pos_Halo[j,2],2,dtype=np.float32), dtype=np.float32)
-        max_halo_pos = np.max(halo_pos)
-        Halo_Pos[i]= max_halo_pos
-        if occupancy1_l <= nhalosub and nhalosub <= occupancy1_h:
-            nHaloSub_1[i] = nhalosub
-        if occupancy2_l <= nhalosub and nhalosub <= occupancy2_h:
-            nHaloSub_2[i] = nhalosub
-            
-    nSub_1=np.sum(nHaloSub_1)
-    nSub_2=np.sum(nHaloSub_2)
-
-    Sub_Halo_Pos_1 = np.empty(nSub_1,dtype=np.float32)
-    Sub_Halo_Pos_2 = np.empty(nSub_2,dtype=np.float32)
-    Ratio_1 = np.empty(nSub_1,dtype=np.float32)
-    Ratio_2 = np.empty(nSub_2,dtype=np.float32)
-
-     
-    progress = -1
-    iSub=0
-    for i in range(0, nHalo):
-        previous_progress = progress
-        progress = int(i/nHalo * 100)
-        if progress != previous_progress:
-            print('Progress sub_IDs for first halo: ', progress, '%')
-        for j in range(0,nHaloSub_1[i]):
-            Pos_Sub_1=f['/'+str(i)+'/'+str(j)+'/subhalo_mean_pos'].value
-            Sub_Halo_Pos_1 = np.sqrt(np.power(Pos_Sub_1[0],2,dtype=np.float32) + np.power(Pos_Sub_1[1],2,dtype=np.float32) +np.power(Pos_Sub_1[2],2,dtype=np.float32), dtype=np.float32)
-            Ratio_1[iSub] = Sub_Halo_Pos_1/Halo_Pos[i]
-            iSub += 1
-
-    progress = -1
-    iSub=0
-    for i in range(0, nHalo):
-        previous_progress = progress
-        progress = int(i/nHalo * 100)
-        if progress != previous_progress:
-            print('Progress sub_IDs for second halo: ', progress, '%')
-        for j in range(0,nHaloSub_2[i]):
-            Pos_Sub_2=f['/'+str(i)+'/'+str(j)+'/subhalo_mean_pos'].value
-            Sub_Halo_Pos_2 = np.sqrt(np.power(Pos_Sub_2[0],2,dtype=np.float32) + np.power(Pos_Sub_2[1],2,dtype=np.float32) +np.power(Pos_Sub_2[2],2,dtype=np.float32), dtype=np.float32)
-            Ratio_2[iSub] = Sub_Halo_Pos_2/Halo_Pos[i]
-            iSub += 1
-        
-  
-    Ratio_1 =  Ratio_1[~np.isnan(Ratio_1)]
-    Ratio_2 =  Ratio_2[~np.isnan(Ratio_2)]
-
-    bins = 50
-
-    H_1 , bin_edge_1 = np.histogram(Ratio_1, bins, density=True)
-    H_2 , bin_edge_2 = np.histogram(Ratio_2, bins, density=True)
-
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-
-    ax.plot(bin_edge_1[:-1], H_1 , color='r', label='occupancy '+str(occupancy1_l)+'-'+str(occupancy1_h))
-    ax.plot(bin_edge_2[:-1], H_2 , color='g', label='occupancy '+str(occupancy2_l)+'-'+str(occupancy2_h))
-    ax.grid(True)
-    ax.set_xlim(0,1)
-   
-    plt.title('Positions of Sub-halos of different occupancy compared to the Main Halos centre')
-    ax.set_xlabel('Sub-Halo position from Main Halo centre divide by radius of Main Halo ')
-    ax.set_ylabel('Density')
-
-    handles, labels = ax.get_legend_handles_labels()
-    ax.legend(handles, labels)
-
-    plt.savefig('Plots/SubHaloPosComp.png', dpi=fig.dpi)
-
-    plt.clf()
-    
-    return
+import HaloSummary as HS
+import HaloKernels as HK
+import HaloEngine as HE
+import OccupancyIndex as OI
+import HaloHist as HH
+import ArrayCache as AC
+import Bootstrap as BS
+import Catalogue as CA
+import SpatialIndex as SI
+
+def SubHaloRadius(summary):
+    return HK.ParticleNorm(summary['subhalo_mean_pos'])
+
+def SubHaloPosRatio(chunk):
+    # subhalo radius over host radius, with the occupancy of each subhalo's host
+    host = HS.SubHost(chunk)
+    Ratio = SubHaloRadius(chunk)/chunk['Halo_Pos'][host]
+    return Ratio, chunk['nHaloSub'][host]
+
+def PosRatioFunc(halo_snapshot, box_size=None):
+    # radii from the box origin as always, or from the periodic host centres
+    # in units of the host-centric radius when the box size is given
+    if box_size is None:
+        return SubHaloPosRatio
+    return SI.HostCentricRatio(halo_snapshot, box_size)
+
+def CachedRatios(halo_snapshot, func, columns, names=('Ratio', 'nsub'), nproc=1):
+    # per-subhalo arrays of func over the whole catalogue, through the array
+    # cache; only for what needs the raw values (bootstrap bands, scatter
+    # plots), as they grow with the catalogue
+    names = list(names)
+    def compute():
+        return HE.Traverse(halo_snapshot, [HE.CollectAcc(func, columns, names)], nproc=nproc)[0]
+    arrays = AC.Cached(halo_snapshot, func.__name__,
+                       {'columns': columns, 'names': names, 'summary_version': HS.SUMMARY_VERSION}, compute)
+    return tuple(arrays[name] for name in names)
+
+class CountsAcc:
+    # streams an OccupancyHistAcc and finishes with its bin counts
+    def __init__(self, acc):
+        self.acc = acc
+        self.columns = acc.columns
+
+    def Update(self, chunk):
+        self.acc.Update(chunk)
+
+    def Finish(self):
+        return self.acc.Counts()
+
+def CachedCounts(halo_snapshot, acc, nproc=1):
+    # bin counts of acc over the catalogue, through the array cache, so
+    # re-plots with the same bins and occupancy ranges do not rescan
+    hist = acc.hist[0]
+    def compute():
+        return HE.Traverse(halo_snapshot, [CountsAcc(acc)], nproc=nproc)[0]
+    return AC.Cached(halo_snapshot, acc.func.__name__ + 'Counts',
+                     {'columns': acc.columns, 'occupancies': acc.occupancies, 'bins': hist.bins,
+                      'range': hist.range, 'summary_version': HS.SUMMARY_VERSION}, compute)
+
+def OccupancyHist(halo_snapshot, acc, bootstrap=0, seed=0, nproc=1):
+    # result of an OccupancyHistAcc: streamed through the engine, or filled
+    # from the per-subhalo values when a bootstrap band needs them
+    if bootstrap:
+        Ratio, nsub = CachedRatios(halo_snapshot, acc.func, acc.columns, nproc=nproc)
+        acc.Fill(Ratio, nsub)
+        acc.Bootstrap(halo_snapshot, Ratio, nsub, bootstrap, seed, nproc)
+    else:
+        acc.SetCounts(CachedCounts(halo_snapshot, acc, nproc))
+    return acc.Finish()
+
+class OccupancyHistAcc:
+    # one fixed-bin histogram per occupancy range, all filled in the same
+    # pass; func(chunk) gives the (Ratio, nsub) arrays of a chunk
+    def __init__(self, func, occupancies, bins, bin_range):
+        self.func = func
+        self.occupancies = list(occupancies)
+        self.hist = [HH.FixedHistogram(bins, bin_range) for occupancy in self.occupancies]
+        self.bands = None
+
+    def Update(self, chunk):
+        self.Fill(*self.func(chunk))
+
+    def Fill(self, Ratio, nsub):
+        for (occupancy_l, occupancy_h), hist in zip(self.occupancies, self.hist):
+            hist.Update(Ratio[OI.SelectHosts(nsub, occupancy_l, occupancy_h)])
+
+    def Counts(self):
+        return {'counts': np.array([hist.counts for hist in self.hist]),
+                'underflow': np.array([hist.underflow for hist in self.hist]),
+                'overflow': np.array([hist.overflow for hist in self.hist])}
+
+    def SetCounts(self, arrays):
+        for k, hist in enumerate(self.hist):
+            hist.counts = arrays['counts'][k]
+            hist.underflow = int(arrays['underflow'][k])
+            hist.overflow = int(arrays['overflow'][k])
+
+    def Bootstrap(self, halo_snapshot, Ratio, nsub, n_resample, seed=0, nproc=1):
+        # host-resampled confidence bands of every density, from the same
+        # per-subhalo arrays as Fill
+        host, nHaloSub = BS.SubhaloHosts(halo_snapshot)
+        self.bands = BS.OccupancyBands(Ratio, nsub, host, nHaloSub, self.occupancies, self.hist[0],
+                                       n_resample, seed=seed, nproc=nproc)
+
+    def Densities(self):
+        for (occupancy_l, occupancy_h), hist in zip(self.occupancies, self.hist):
+            if hist.underflow or hist.overflow:
+                print('occupancy', occupancy_l, '-', occupancy_h, 'outside bin range:',
+                      hist.underflow, 'below,', hist.overflow, 'above')
+        return [(hist.Density(), hist.edges) for hist in self.hist]
+
+class SubHaloPosAcc(OccupancyHistAcc):
+    columns = ['nHaloSub', 'Halo_Pos', 'subhalo_mean_pos']
+
+    def __init__(self, occupancy_l, occupancy_h, bins=50, bin_range=(0, 1), func=SubHaloPosRatio):
+        OccupancyHistAcc.__init__(self, func, [(occupancy_l, occupancy_h)], bins, bin_range)
+
+    def Finish(self):
+        return {'figure': 'SubHaloPos', 'occupancies': self.occupancies, 'densities': self.Densities(), 'bands': self.bands}
+
+def SubHaloPos(halo_snapshot, occupancy_l, occupancy_h, bins=50, bootstrap=0, nproc=1, seed=0, box_size=None):
+    # bootstrap: number of host resamples for the confidence band (0 for none);
+    # box_size: measure host-centric radii in this periodic box
+    acc = SubHaloPosAcc(occupancy_l, occupancy_h, bins, func=PosRatioFunc(halo_snapshot, box_size))
+    return OccupancyHist(halo_snapshot, acc, bootstrap, seed, nproc)
+
+def SubHaloPosQuery(halo_snapshot, occupancy_l, occupancy_h, bins=50):
+    # SubHaloPos through a catalogue query: only the subhalos of hosts in
+    # the occupancy window, and only the columns of the ratio, are read
+    cat = CA.Catalogue(halo_snapshot)
+    subs = cat.subs.Where(cat.hosts.nsub.Between(occupancy_l, occupancy_h))
+    data = subs.Read('mean_pos', 'host.radius', 'host.nsub')
+    acc = SubHaloPosAcc(occupancy_l, occupancy_h, bins)
+    acc.Fill(HK.ParticleNorm(data['mean_pos'])/data['host.radius'], data['host.nsub'])
+    return acc.Finish()
+
+class SubHaloPosCompAcc(OccupancyHistAcc):
+    columns = ['nHaloSub', 'Halo_Pos', 'subhalo_mean_pos']
+
+    def __init__(self, occupancies, bins=50, bin_range=(0, 1), func=SubHaloPosRatio):
+        OccupancyHistAcc.__init__(self, func, occupancies, bins, bin_range)
+
+    def Finish(self):
+        return {'figure': 'SubHaloPosComp', 'occupancies': self.occupancies, 'densities': self.Densities(), 'bands': self.bands}
+
+def SubHaloPosComp (halo_snapshot, occupancy1_l=0, occupancy1_h=1, occupancy2_l=2, occupancy2_h=4, occupancies=None, bins=50,
+                    bootstrap=0, nproc=1, seed=0, box_size=None):
+    if occupancies is None:
+        occupancies = [(occupancy1_l, occupancy1_h), (occupancy2_l, occupancy2_h)]
+    acc = SubHaloPosCompAcc(occupancies, bins, func=PosRatioFunc(halo_snapshot, box_size))
+    return OccupancyHist(halo_snapshot, acc, bootstrap, seed, nproc)
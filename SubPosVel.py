@@ -1,83 +1,72 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import h5py
+import HaloEngine as HE
+import OccupancyIndex as OI
+import HaloHist as HH
+from SubHaloPos import SubHaloPosRatio, CachedRatios
+from SubHaloVel import SubHaloVelRatio
 
-def SubHaloPosVel(halo_snapshot, occupancy_l, occupancy_h):
-    f=h5py.File(halo_snapshot, 'r', driver='core')
-    nHalo = len([item for item in f.values() if isinstance(item, h5py.Group)])
-    nHaloSub=np.empty(nHalo,dtype=np.int32)
-    Halo_Pos =  np.empty(nHalo,dtype=np.float32)
-    halo_pos =  np.empty(nHalo,dtype=np.float32)
-    Halo_Vel =  np.empty(nHalo,dtype=np.float32)
-    halo_vel=  np.empty(nHalo,dtype=np.float32)
-    Sigma =  np.empty(nHalo,dtype=np.float32)
+def SubHaloPosVelRatio(chunk):
+    # position ratio, relative speed and host occupancy of every subhalo
+    RatioPos, nsub = SubHaloPosRatio(chunk)
+    RatioVel, nsub = SubHaloVelRatio(chunk)
+    return RatioPos, abs(RatioVel), nsub
 
-    progress = -1
-    iSub=0
-    nSub=0
-    for i in range(0,nHalo):
-        previous_progress = progress
-        progress = int(i/nHalo * 100)
-        if progress != previous_progress:
-            print('Progress main_IDs: ', progress, '%')
-        nhalosub = len([item for item in f['/'+str(i)].values() if isinstance(item, h5py.Group)])
-        Pos_Halo=f['/'+str(i)+'/'+'Halo_Pos'].value
-        halo_pos =  np.empty(len(Pos_Halo),dtype=np.float32)
-        Vel_Halo=f['/'+str(i)+'/'+'Halo_Vel'].value
-        Vel_Halo_Mean=f['/'+str(i)+'/'+'mean_vel'].value
-        halo_vel =  np.empty(len(Vel_Halo),dtype=np.float32)
-        for j in range (0, len(Pos_Halo)):
-            halo_pos[j]= np.sqrt(np.power(Pos_Halo[j,0],2,dtype=np.float32) + np.power(Pos_Halo[j,1],2,dtype=np.float32) +np.power(Pos_Halo[j,2],2,dtype=np.float32), dtype=np.float32)
-        max_halo_pos = np.max(halo_pos)
-        Halo_Pos[i]= max_halo_pos
-        for j in range (0, len(Vel_Halo)):
-            halo_vel[j]= np.sqrt(np.power(Vel_Halo[j,0],2,dtype=np.float32) + np.power(Vel_Halo[j,1],2,dtype=np.float32) +np.power(Vel_Halo[j,2],2,dtype=np.float32), dtype=np.float32)
-        mean_halo_vel = np.mean(halo_vel)
-        Halo_Vel[i]= mean_halo_vel
-        U = Vel_Halo - Vel_Halo_Mean
-        Sigma[i] = np.dot(U[j,:],U[j,:])
-        if occupancy_l <= nhalosub and nhalosub <= occupancy_h:
-            nHaloSub[i] = nhalosub 
-    nSub=np.sum(nHaloSub)
+def PosVelRatios(halo_snapshot, nproc=1):
+    return CachedRatios(halo_snapshot, SubHaloPosVelRatio, SubHaloPosVelAcc.columns,
+                        names=('RatioPos', 'RatioVel', 'nsub'), nproc=nproc)
 
-    Sub_Halo_Pos = np.empty(nSub,dtype=np.float32)
-    Sub_Halo_Vel = np.empty(nSub,dtype=np.float32)
-    RatioPos = np.empty(nSub,dtype=np.float32)
-    RatioVel = np.empty(nSub,dtype=np.float32)
-        
-    progress = -1
-    for i in range(0, nHalo):
-        previous_progress = progress
-        progress = int(i/nHalo * 100)
-        if progress != previous_progress:
-            print('Progress sub_IDs: ', progress, '%')
-        for j in range(0,nHaloSub[i]):
-            Pos_Sub=f['/'+str(i)+'/'+str(j)+'/subhalo_mean_pos'].value
-            Sub_Halo_Pos = np.sqrt(np.power(Pos_Sub[0],2,dtype=np.float32) + np.power(Pos_Sub[1],2,dtype=np.float32) +np.power(Pos_Sub[2],2,dtype=np.float32), dtype=np.float32)
-            Vel_Sub=f['/'+str(i)+'/'+str(j)+'/subhalo_mean_vel'].value
-            Sub_Halo_Vel = np.sqrt(np.power(Vel_Sub[0],2,dtype=np.float32) + np.power(Vel_Sub[1],2,dtype=np.float32) +np.power(Vel_Sub[2],2,dtype=np.float32), dtype=np.float32)
-            RatioPos[iSub] = Sub_Halo_Pos/Halo_Pos[i]
-            RatioVel[iSub] = abs(Sub_Halo_Vel-Halo_Vel[i])/np.sqrt(Sigma[i])
-            iSub += 1
-       
-    RatioPos =  RatioPos[~np.isnan(RatioPos)]
-    RatioVel =  RatioVel[~np.isnan(RatioVel)]
+class SubHaloPosVelAcc:
+    columns = ['nHaloSub', 'Halo_Pos', 'Halo_Vel', 'Sigma', 'subhalo_mean_pos', 'subhalo_mean_vel']
 
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
+    def __init__(self, occupancy_l, occupancy_h):
+        self.occupancy_l = occupancy_l
+        self.occupancy_h = occupancy_h
+        self.RatioPos = []
+        self.RatioVel = []
 
-    ax.scatter(RatioPos, RatioVel, color='r', marker='.')
-    ax.grid(True)
+    def Update(self, chunk):
+        self.Fill(*SubHaloPosVelRatio(chunk))
 
-    ax.set_xscale('log')
-    ax.set_yscale('log')
-    ax.set_ylim(10**-4, 0.2*10**2)
-    
-    ax.set_xlabel('Sub-halo position in Main halo')
-    ax.set_ylabel('Sub-halo relative speed')
+    def Fill(self, RatioPos, RatioVel, nsub):
+        keep = OI.SelectHosts(nsub, self.occupancy_l, self.occupancy_h)
+        self.RatioPos.append(RatioPos[keep])
+        self.RatioVel.append(RatioVel[keep])
 
-    plt.savefig('Plots/SubHaloPosVel_Occ='+str(occupancy_l)+'-'+str(occupancy_h)+'.png', dpi=fig.dpi)
+    def Finish(self):
+        occupancy_l, occupancy_h = self.occupancy_l, self.occupancy_h
+        RatioPos = np.concatenate(self.RatioPos)
+        RatioVel = np.concatenate(self.RatioVel)
+        # drop a subhalo when either ratio is NaN, keeping the pairs aligned
+        paired = ~(np.isnan(RatioPos) | np.isnan(RatioVel))
+        RatioPos = RatioPos[paired]
+        RatioVel = RatioVel[paired]
 
-    plt.clf()
-    
-    return
+        return {'figure': 'SubHaloPosVel', 'occupancy': (occupancy_l, occupancy_h),
+                'RatioPos': RatioPos, 'RatioVel': RatioVel}
+
+class SubHaloPosVelDensityAcc(SubHaloPosVelAcc):
+    # streaming log-binned 2D histogram of the same plane, filled chunk by
+    # chunk: the accumulator holds only the bin counts
+    def __init__(self, occupancy_l, occupancy_h, bins=100, pos_range=(10**-4, 1), vel_range=(10**-4, 0.2*10**2)):
+        SubHaloPosVelAcc.__init__(self, occupancy_l, occupancy_h)
+        self.hist = HH.LogHistogram2D(bins, pos_range, vel_range)
+
+    def Fill(self, RatioPos, RatioVel, nsub):
+        keep = OI.SelectHosts(nsub, self.occupancy_l, self.occupancy_h)
+        self.hist.Update(RatioPos[keep], RatioVel[keep])
+
+    def Finish(self):
+        hist = self.hist
+        if hist.outside:
+            print('occupancy', self.occupancy_l, '-', self.occupancy_h, 'outside bin range:', hist.outside)
+        return {'figure': 'SubHaloPosVelDensity', 'occupancy': (self.occupancy_l, self.occupancy_h),
+                'density': hist.Density(), 'counts': hist.counts,
+                'pos_edges': hist.x_edges, 'vel_edges': hist.y_edges}
+
+def SubHaloPosVel(halo_snapshot, occupancy_l, occupancy_h, density=False, bins=100, nproc=1):
+    if density:
+        # one pass over the catalogue, no per-subhalo arrays kept or cached
+        return HE.Traverse(halo_snapshot, [SubHaloPosVelDensityAcc(occupancy_l, occupancy_h, bins)], nproc=nproc)[0]
+    acc = SubHaloPosVelAcc(occupancy_l, occupancy_h)
+    acc.Fill(*PosVelRatios(halo_snapshot, nproc))
+    return acc.Finish()
@@ -0,0 +1,217 @@
+import os
+import shutil
+import json
+import numpy as np
+
+# Columnar on-disk merger tree store replacing treedata.pck pickles.
+#
+# The pickles are nested dicts tree_data[snap][haloID] -> halo dict, keyed
+# by snapshot string ('061') and halo ID string.  The store keeps one
+# directory per snapshot of plain .npy arrays, read lazily through memory
+# maps:
+#   <store>/meta.json                 snapshot labels (ascending), fields used
+#   <store>/times.npy                 cosmic time of every snapshot (NaN if unknown)
+#   <store>/<snap>/halo_ids.npy       int64, ascending
+#   <store>/<snap>/nPart.npy          particle count of every halo
+#   <store>/<snap>/prog_offset.npy    halo k's progenitors (in the previous
+#   <store>/<snap>/prog_ids.npy         snapshot) are prog_ids[prog_offset[k]:prog_offset[k+1]]
+#   <store>/<snap>/desc_offset.npy    halo k's descendants (in the next
+#   <store>/<snap>/desc_ids.npy         snapshot), same layout
+#   <store>/derived/                  arrays computed from the store (main
+#                                       progenitors, count statistics); they
+#                                       are dropped whenever the store is rewritten
+#                                       and written through SaveDerived
+#
+# FIELDS names the keys of the per-halo dicts in the pickles; pass
+# fields= to WriteTreeStore if a pickle uses different names.
+#
+# Snapshot times come from snap_data: plain numbers are times, dicts need
+# one of TIME_KEYS (or time_key).  A redshift is never taken as a time;
+# with cosmology=(H0, Om0) a redshift-only entry is converted to the age of
+# a flat LCDM universe in Gyr, otherwise writing the store fails.
+
+FIELDS = {'nPart': 'current_halo_nPart', 'progs': 'Prog_haloIDs', 'descs': 'Desc_haloIDs'}
+TIME_KEYS = ('t', 'time', 'age')
+REDSHIFT_KEYS = ('z', 'redshift')
+HUBBLE_TIME_GYR = 977.79
+
+def IDArray(ids):
+    if ids is None:
+        return np.zeros(0, dtype=np.int64)
+    return np.atleast_1d(np.asarray(ids, dtype=np.int64))
+
+def EdgeArrays(records, key):
+    # CSR offsets and flattened IDs of one edge field
+    lists = [IDArray(record.get(key)) for record in records]
+    offset = np.zeros(len(records)+1, dtype=np.int64)
+    np.cumsum([len(x) for x in lists], out=offset[1:])
+    flat = np.concatenate(lists) if lists else np.zeros(0, dtype=np.int64)
+    return offset, flat
+
+def CosmicTime(z, cosmology):
+    # age at redshift z of a flat LCDM universe, in Gyr; cosmology = (H0, Om0)
+    H0, Om0 = cosmology
+    OL0 = 1 - Om0
+    return 2/(3*np.sqrt(OL0))*HUBBLE_TIME_GYR/H0*np.arcsinh(np.sqrt(OL0/Om0)*(1 + z)**-1.5)
+
+def SnapTime(value, key=None, cosmology=None):
+    # value of `key` (or the time) of a snap_data entry, a plain number or a dict
+    if not isinstance(value, dict):
+        return float(value)
+    if key is None:
+        keys = [k for k in TIME_KEYS if k in value]
+        if not keys and cosmology is not None:
+            keys = [k for k in REDSHIFT_KEYS if k in value]
+        if not keys:
+            raise KeyError('snap_data entry without a time (keys {}): pass time_key, or cosmology=(H0, Om0) '
+                           'to convert its redshift'.format(sorted(value)))
+        key = keys[0]
+    if key not in value:
+        raise KeyError('snap_data entry without {!r} (keys {})'.format(key, sorted(value)))
+    if key in REDSHIFT_KEYS and cosmology is not None:
+        return float(CosmicTime(float(value[key]), cosmology))
+    return float(value[key])
+
+def WriteSnapshot(store_dir, snap, halos, fields):
+    # halos: the tree_data[snap] dict
+    snap_dir = os.path.join(store_dir, snap)
+    os.makedirs(snap_dir, exist_ok=True)
+    keys = sorted(halos.keys(), key=lambda hid: int(hid))
+    ids = np.array([int(hid) for hid in keys], dtype=np.int64)
+    records = [halos[hid] for hid in keys]
+    nPart = np.array([record.get(fields['nPart'], 0) for record in records], dtype=np.int64)
+    prog_offset, prog_ids = EdgeArrays(records, fields['progs'])
+    desc_offset, desc_ids = EdgeArrays(records, fields['descs'])
+    np.save(os.path.join(snap_dir, 'halo_ids.npy'), ids)
+    np.save(os.path.join(snap_dir, 'nPart.npy'), nPart)
+    np.save(os.path.join(snap_dir, 'prog_offset.npy'), prog_offset)
+    np.save(os.path.join(snap_dir, 'prog_ids.npy'), prog_ids)
+    np.save(os.path.join(snap_dir, 'desc_offset.npy'), desc_offset)
+    np.save(os.path.join(snap_dir, 'desc_ids.npy'), desc_ids)
+    return len(ids)
+
+def WriteTreeStore(tree_data, store_dir, snap_data=None, fields=None, time_key=None, cosmology=None):
+    if fields is None:
+        fields = FIELDS
+    if time_key in REDSHIFT_KEYS and cosmology is None:
+        raise ValueError('time_key {!r} is a redshift: pass cosmology=(H0, Om0) to convert it'.format(time_key))
+    os.makedirs(store_dir, exist_ok=True)
+    snaps = sorted(tree_data.keys(), key=lambda snap: int(snap))
+    for snap in snaps:
+        nHalo = WriteSnapshot(store_dir, snap, tree_data[snap], fields)
+        print('Snapshot', snap, ':', nHalo, 'halos')
+    times = np.full(len(snaps), np.nan)
+    if snap_data is not None:
+        for k, snap in enumerate(snaps):
+            if snap in snap_data:
+                times[k] = SnapTime(snap_data[snap], time_key, cosmology)
+    np.save(os.path.join(store_dir, 'times.npy'), times)
+    shutil.rmtree(os.path.join(store_dir, 'derived'), ignore_errors=True)
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as meta:
+        json.dump({'snapshots': snaps, 'fields': fields}, meta)
+    return store_dir
+
+def ConvertPickle(tree_pickle, store_dir, snap_pickle=None, fields=None, time_key=None, cosmology=None):
+    # one-off conversion of treedata.pck (+ snapdatatime.pck)
+    import pickle
+    with open(tree_pickle, 'rb') as pfile:
+        tree_data = pickle.load(pfile)
+    snap_data = None
+    if snap_pickle is not None:
+        with open(snap_pickle, 'rb') as pfile:
+            snap_data = pickle.load(pfile)
+    return WriteTreeStore(tree_data, store_dir, snap_data, fields, time_key, cosmology)
+
+class TreeStore:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json')) as meta:
+            meta = json.load(meta)
+        self.snapshots = meta['snapshots']
+        self.fields = meta['fields']
+        self.times = np.load(os.path.join(store_dir, 'times.npy'))
+        self._arrays = {}
+
+    def Array(self, snap, name):
+        key = (snap, name)
+        if key not in self._arrays:
+            path = os.path.join(self.store_dir, snap, name+'.npy')
+            self._arrays[key] = np.load(path, mmap_mode='r')
+        return self._arrays[key]
+
+    def DerivedPath(self, name):
+        derived = os.path.join(self.store_dir, 'derived')
+        os.makedirs(derived, exist_ok=True)
+        return os.path.join(derived, name)
+
+    def SaveDerived(self, name, arrays):
+        # .npy of one array or .npz of a dict, written under a temporary
+        # name and renamed, so an interrupted write leaves no partial file
+        path = self.DerivedPath(name)
+        with open(path + '.tmp', 'wb') as out:
+            if isinstance(arrays, dict):
+                np.savez(out, **arrays)
+            else:
+                np.save(out, arrays)
+        os.replace(path + '.tmp', path)
+        return path
+
+    def SnapIndex(self, snap):
+        return self.snapshots.index(snap)
+
+    def HaloIDs(self, snap):
+        return self.Array(snap, 'halo_ids')
+
+    def nPart(self, snap):
+        return self.Array(snap, 'nPart')
+
+    def Rows(self, snap, ids):
+        # row of every halo ID in a snapshot, -1 where it is missing
+        halo_ids = self.HaloIDs(snap)
+        ids = np.atleast_1d(np.asarray(ids, dtype=np.int64))
+        if len(halo_ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        rows = np.searchsorted(halo_ids, ids)
+        rows[rows == len(halo_ids)] = 0
+        rows[halo_ids[rows] != ids] = -1
+        return rows
+
+    def Edges(self, snap, kind):
+        # kind 'prog' or 'desc': (offset, ids)
+        return self.Array(snap, kind+'_offset'), self.Array(snap, kind+'_ids')
+
+    def Progenitors(self, snap, hid):
+        offset, ids = self.Edges(snap, 'prog')
+        row = self.Rows(snap, hid)[0]
+        if row < 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.asarray(ids[offset[row]:offset[row+1]])
+
+    def Descendants(self, snap, hid):
+        offset, ids = self.Edges(snap, 'desc')
+        row = self.Rows(snap, hid)[0]
+        if row < 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.asarray(ids[offset[row]:offset[row+1]])
+
+    def Branch(self, snap, hid):
+        # (snapshot, halo ID, nPart) along the most massive progenitor line
+        branch = []
+        k = self.SnapIndex(snap)
+        while hid is not None and k >= 0:
+            snap = self.snapshots[k]
+            row = self.Rows(snap, hid)[0]
+            if row < 0:
+                break
+            branch.append((snap, int(hid), int(self.nPart(snap)[row])))
+            progs = self.Progenitors(snap, hid)
+            hid = None
+            if len(progs) and k > 0:
+                prev = self.snapshots[k-1]
+                prog_rows = self.Rows(prev, progs)
+                prog_rows = prog_rows[prog_rows >= 0]
+                if len(prog_rows):
+                    masses = self.nPart(prev)[prog_rows]
+                    hid = self.HaloIDs(prev)[prog_rows[np.argmax(masses)]]
+            k -= 1
+        return branch